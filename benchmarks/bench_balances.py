@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Compare the single-pass balance aggregation in load_data against the
+# BQL query it replaced, on a synthetic ledger.
+#
+# Usage: python benchmarks/bench_balances.py [--members N] [--txns N]
+
+import time
+import timeit
+
+import click
+import beancount.loader
+import beancount.query.query
+
+from backtab import data_repo
+from synthetic_repo import synthetic_ledger
+
+
+def bql_balances(entries, options):
+    return {
+        row.account: row.balance
+        for row in beancount.query.query.run_query(entries, options, """
+            select account, sum(position) as balance
+            where PARENT(account) = "Liabilities:Bar:Members"
+               OR account = "Assets:Cash:Bar"
+            group by account
+            """)[1]
+    }
+
+
+@click.command()
+@click.option("--members", default=300)
+@click.option("--txns", default=100000)
+@click.option("--repeat", default=5)
+def main(members, txns, repeat):
+    print("Generating ledger with %d members and %d transactions" % (members, txns))
+    start = time.perf_counter()
+    entries, errors, options = beancount.loader.load_string(synthetic_ledger(members, txns))
+    assert not errors, errors
+    print("Loaded in %.2fs" % (time.perf_counter() - start,))
+
+    bql = bql_balances(entries, options)
+    single_pass, _ = data_repo.aggregate_balances(entries)
+    assert bql == single_pass, "Balances differ"
+
+    bql_time = min(timeit.repeat(lambda: bql_balances(entries, options),
+                                 number=1, repeat=repeat))
+    single_pass_time = min(timeit.repeat(lambda: data_repo.aggregate_balances(entries),
+                                         number=1, repeat=repeat))
+    print("BQL query:    %8.1f ms" % (bql_time * 1000,))
+    print("Single pass:  %8.1f ms" % (single_pass_time * 1000,))
+    print("Speedup:      %8.1fx" % (bql_time / single_pass_time,))
+
+
+if __name__ == "__main__":
+    main()
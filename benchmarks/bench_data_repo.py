@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# Benchmarks for the hot paths in data_repo, run against a synthetic data
+# repo (see synthetic_repo.py) cloned from a local bare remote:
+#
+#   load_data_full      full load of the ledger, without a snapshot
+#   load_data_snapshot  load from the snapshot left by the full load
+#   buy_txn             constructing a BuyTxn
+#   apply_txn           appending a purchase to the instance ledger
+#   commit_push         committing and pushing a batch of purchases
+#   render_accounts     rendering the /accounts response
+#   import_server       importing backtab.server in a fresh interpreter
+#   startup_blocking    starting backtab-server until /accounts answers,
+#                       pulling before serving
+#   startup_deferred    the same, serving from the snapshot while pulling
+#   startup_offline     the same, with the remote unreachable
+#
+# Results are compared against benchmarks/baselines.json; anything slower
+# than the baseline by more than the tolerance is reported as a
+# regression, and makes the exit status nonzero. Baselines are only
+# meaningful on the machine they were recorded on; record your own with
+# --save-baseline before making changes.
+#
+# Usage: python benchmarks/bench_data_repo.py [--members N] [--txns N]
+#            [--only NAME] [--save-baseline]
+
+import contextlib
+import io
+import json
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+import urllib.request
+
+import click
+
+from backtab import data_repo, server
+import load_test
+import synthetic_repo
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# Benchmark functions by name. Each gets the fixture and returns the
+# seconds per operation of a single run.
+BENCHMARKS: typing.Dict[str, typing.Callable[["Fixture"], float]] = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+@contextlib.contextmanager
+def quiet():
+    """Hide what backtab prints while it works"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+class Fixture:
+    path: str
+    remote_path: str
+    data_path: str
+    ops: int
+
+    def __init__(self, path: str, ops: int, **repo_options):
+        self.path = path
+        self.ops = ops
+        self.remote_path, self.data_path = synthetic_repo.make_remote(path, **repo_options)
+
+    def repo(self, snapshot: bool = True) -> data_repo.RepoData:
+        """A freshly loaded RepoData for the clone"""
+        repo = data_repo.RepoData(repo_path=self.data_path)
+        if not snapshot and os.path.exists(repo.snapshot_path):
+            os.unlink(repo.snapshot_path)
+        with quiet():
+            repo.load_data()
+        return repo
+
+    def purchases(self, repo: data_repo.RepoData, count: int) -> typing.List[data_repo.BuyTxn]:
+        state = repo.state
+        members = list(state.accounts.values())
+        products = list(state.products.values())
+        return [
+            data_repo.BuyTxn(members[i % len(members)],
+                             [(products[i % len(products)], 1), (products[(i * 7) % len(products)], 2)])
+            for i in range(count)
+        ]
+
+
+@benchmark
+def load_data_full(fixture: Fixture) -> float:
+    repo = data_repo.RepoData(repo_path=fixture.data_path)
+    if os.path.exists(repo.snapshot_path):
+        os.unlink(repo.snapshot_path)
+    with quiet():
+        start = time.perf_counter()
+        repo.load_data()
+        return time.perf_counter() - start
+
+
+@benchmark
+def load_data_snapshot(fixture: Fixture) -> float:
+    fixture.repo()
+    repo = data_repo.RepoData(repo_path=fixture.data_path)
+    with quiet():
+        start = time.perf_counter()
+        repo.load_data()
+        elapsed = time.perf_counter() - start
+    assert repo.accounts
+    return elapsed
+
+
+@benchmark
+def buy_txn(fixture: Fixture) -> float:
+    repo = fixture.repo()
+    start = time.perf_counter()
+    fixture.purchases(repo, fixture.ops)
+    return (time.perf_counter() - start) / fixture.ops
+
+
+@benchmark
+def apply_txn(fixture: Fixture) -> float:
+    repo = fixture.repo()
+    txns = fixture.purchases(repo, fixture.ops + 1)
+    with quiet():
+        # The first transaction creates the instance ledger and pushes it
+        repo.apply_txn(txns[0])
+        start = time.perf_counter()
+        for txn in txns[1:]:
+            repo.apply_txn(txn)
+        elapsed = time.perf_counter() - start
+        repo.flush()
+        repo.close_instance_ledger()
+    return elapsed / fixture.ops
+
+
+@benchmark
+def commit_push(fixture: Fixture) -> float:
+    repo = fixture.repo()
+    txns = fixture.purchases(repo, fixture.ops + 1)
+    with quiet():
+        repo.apply_txn(txns[0])
+        repo.flush()
+        repo.apply_txns(txns[1:])
+        start = time.perf_counter()
+        repo.flush()
+        elapsed = time.perf_counter() - start
+        repo.close_instance_ledger()
+    return elapsed
+
+
+@benchmark
+def render_accounts(fixture: Fixture) -> float:
+    state = fixture.repo().state
+    render = server.render_accounts.__wrapped__
+    start = time.perf_counter()
+    for _ in range(fixture.ops):
+        json.dumps(render(state)).encode("utf-8")
+    return (time.perf_counter() - start) / fixture.ops
+
+
+@benchmark
+def import_server(fixture: Fixture) -> float:
+    output = subprocess.check_output([
+        sys.executable, "-c",
+        "import time; start = time.perf_counter(); import backtab.server; print(time.perf_counter() - start)"])
+    return float(output)
+
+
+def time_startup(fixture: Fixture, startup: str) -> float:
+    """Seconds from starting a server until /accounts answers"""
+    # Leave a snapshot behind, as a previous run would have
+    fixture.repo()
+    start = time.perf_counter()
+    instance = load_test.Server(fixture.path, 0, fixture.remote_path, fixture.data_path,
+                                commit_delay=1, http_server="threaded", startup=startup)
+    try:
+        while True:
+            if instance.process.poll() is not None:
+                raise RuntimeError("Server exited; see %s" % (instance.log_path,))
+            try:
+                urllib.request.urlopen(instance.url + "/accounts", timeout=1).read()
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+    finally:
+        instance.stop()
+
+
+@benchmark
+def startup_blocking(fixture: Fixture) -> float:
+    return time_startup(fixture, "blocking")
+
+
+@benchmark
+def startup_deferred(fixture: Fixture) -> float:
+    return time_startup(fixture, "deferred")
+
+
+@benchmark
+def startup_offline(fixture: Fixture) -> float:
+    os.rename(fixture.remote_path, fixture.remote_path + ".offline")
+    try:
+        return time_startup(fixture, "deferred")
+    finally:
+        os.rename(fixture.remote_path + ".offline", fixture.remote_path)
+
+
+def load_baselines() -> typing.Dict:
+    try:
+        with open(BASELINE_FILE, "rt") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+@click.command()
+@click.option("--members", default=300)
+@click.option("--products", default=30)
+@click.option("--txns", default=20000, help="Transactions in the generated ledger")
+@click.option("--instances", default=4, help="Instance ledgers in the generated repo")
+@click.option("--ops", default=200, help="Operations per run of the per-operation benchmarks")
+@click.option("--repeat", default=3, help="Runs of each benchmark; the fastest one counts")
+@click.option("--only", multiple=True, type=click.Choice(list(BENCHMARKS)))
+@click.option("--tolerance", default=1.25, help="Slowdown relative to the baseline that counts as a regression")
+@click.option("--save-baseline", is_flag=True, help="Record these results as the new baseline")
+def main(members, products, txns, instances, ops, repeat, only, tolerance, save_baseline):
+    params = dict(members=members, products=products, txns=txns, instances=instances, ops=ops)
+    names = list(only) or list(BENCHMARKS)
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        print("Generating data repo with %d members, %d products and %d transactions"
+              % (members, products, txns))
+        fixture = Fixture(path, ops, members=members, products=products, txns=txns,
+                          instances=instances)
+        for name in names:
+            results[name] = min(BENCHMARKS[name](fixture) for _ in range(repeat))
+
+    baselines = load_baselines()
+    if baselines.get("params") != params:
+        if baselines:
+            print("Baseline was recorded with different parameters (%r); not comparing"
+                  % (baselines.get("params"),))
+        baselines = {}
+    baseline_results = baselines.get("results", {})
+
+    regressions = []
+    print()
+    print("%-20s %12s %12s %8s" % ("benchmark", "ms/op", "baseline", "ratio"))
+    for name in names:
+        line = "%-20s %12.3f" % (name, results[name] * 1000)
+        if name in baseline_results:
+            ratio = results[name] / baseline_results[name]
+            line += " %12.3f %7.2fx" % (baseline_results[name] * 1000, ratio)
+            if ratio > tolerance:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+
+    if save_baseline:
+        if baselines.get("params") == params:
+            baseline_results.update(results)
+        else:
+            baseline_results = results
+        with open(BASELINE_FILE, "wt") as f:
+            json.dump({"params": params, "results": baseline_results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Saved baseline to %s" % (BASELINE_FILE,))
+    elif regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Time the local git operations done for every committed batch (add,
+# commit, HEAD lookup) and hard resets with each git backend.
+#
+# Usage: python benchmarks/bench_git.py [--commits N]
+
+import os.path
+import subprocess
+import tempfile
+import time
+
+import click
+
+from backtab import git
+
+
+def make_repo(path: str):
+    subprocess.run(["git", "init", "-q", path], check=True)
+    subprocess.run(["git", "config", "user.name", "bench"], cwd=path, check=True)
+    subprocess.run(["git", "config", "user.email", "bench@example.com"], cwd=path, check=True)
+    os.mkdir(os.path.join(path, "ledger"))
+    with open(os.path.join(path, "ledger", "instance.beancount"), "wt") as f:
+        f.write("; instance ledger\n")
+    subprocess.run(["git", "add", "-A"], cwd=path, check=True)
+    subprocess.run(["git", "commit", "-qm", "init"], cwd=path, check=True)
+
+
+def time_backend(backend: str, commits: int) -> dict:
+    with tempfile.TemporaryDirectory() as path:
+        make_repo(path)
+        repo = git.open_repo(path, backend)
+        ledger = os.path.join(path, "ledger", "instance.beancount")
+        timings = {"add": 0.0, "commit": 0.0, "head": 0.0, "reset": 0.0}
+        for i in range(commits):
+            with open(ledger, "at") as f:
+                f.write('2020-01-01 txn "purchase %d"\n' % (i,))
+            start = time.perf_counter()
+            repo.add(ledger)
+            timings["add"] += time.perf_counter() - start
+            start = time.perf_counter()
+            repo.commit("Automatic commit by backtab")
+            timings["commit"] += time.perf_counter() - start
+            start = time.perf_counter()
+            head = repo.head()
+            timings["head"] += time.perf_counter() - start
+            with open(ledger, "at") as f:
+                f.write("garbage\n")
+            start = time.perf_counter()
+            repo.reset_hard(head)
+            timings["reset"] += time.perf_counter() - start
+        return {op: total / commits for op, total in timings.items()}
+
+
+@click.command()
+@click.option("--commits", default=50)
+def main(commits):
+    results = {}
+    for backend in git.BACKENDS:
+        try:
+            results[backend] = time_backend(backend, commits)
+        except ImportError:
+            print("Skipping %s backend; it is not installed" % (backend,))
+    print()
+    print("%-12s" % ("ms/op",) + "".join("%10s" % (op,) for op in ["add", "commit", "head", "reset"]))
+    for backend, timings in results.items():
+        print("%-12s" % (backend,) + "".join("%10.2f" % (timings[op] * 1000,)
+                                              for op in ["add", "commit", "head", "reset"]))
+
+
+if __name__ == "__main__":
+    main()
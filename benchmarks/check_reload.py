@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# Check that pulling changes into a loaded RepoData ends up with the same
+# state as loading the ledger from scratch, whether the pull managed an
+# incremental reload or not. A second clone of a synthetic data repo (see
+# synthetic_repo.py) pushes a series of changes; after each pull, the
+# accounts, stats and history are compared with a full load of the same
+# commit in a third clone, and with what the snapshot left behind restores.
+# Changes that a full load rejects must make the pull fail instead.
+#
+# Exits with a nonzero status if anything differs.
+#
+# Usage: python benchmarks/check_reload.py [--members N] [--txns N]
+
+import contextlib
+import io
+import os.path
+import subprocess
+import sys
+import tempfile
+import typing
+
+import click
+
+from backtab import data_repo
+import synthetic_repo
+
+MEMBER = synthetic_repo.MEMBERS_ACCT + ":Member0001"
+NEW_MEMBER = synthetic_repo.MEMBERS_ACCT + ":Member9999"
+INSTANCE_LEDGER = "ledger/bench1_2015-01-01 00:00:00.000000+00:00.beancount"
+NEW_LEDGER = "ledger/check_2024-01-01 00:00:00.000000+00:00.beancount"
+MERGED_LEDGER = "ledger/merged_2024-01-03 00:00:00.000000+00:00.beancount"
+
+
+def txn(date: str, narration: str, *postings: str, kind: str = "deposit") -> str:
+    return ('\n%s txn "%s"\n  timestamp: "%s 12:00:00"\n  type: "%s"\n' % (date, narration, date, kind) +
+            "".join("  %s\n" % (posting,) for posting in postings))
+
+
+def deposit(date: str, account: str, cents: int) -> str:
+    amount = "%d.%02d" % divmod(cents, 100)
+    return txn(date, "deposited %s" % (amount,),
+               "%s  -%s EUR" % (account, amount), "Assets:Cash:Bar  %s EUR" % (amount,))
+
+
+def purchase(date: str, account: str) -> str:
+    return txn(date, "bought 2 items", "Assets:Inventory:Bar  -2 MATE", "%s  2 MATE" % (account,),
+               "%s  3.00 EUR" % (account,), "Income:Bar  -3.00 EUR", kind="purchase")
+
+
+def insert_include(filename: str) -> typing.Callable[[str], str]:
+    """Insert an include before the last line, like a union merge of two
+    instances starting at the same time does"""
+    def insert(text: str) -> str:
+        lines = text.splitlines(keepends=True)
+        return "".join(lines[:-1] + ['include "%s"\n' % (os.path.basename(filename),)] + lines[-1:])
+    return insert
+
+
+# The changes pushed, in order: (description, {file: text to append, or a
+# function rewriting the file}, expected outcome). "incremental" and "full"
+# are the reloads expected; "rejected" changes get taken back after the pull
+# fails.
+CASES: typing.List[typing.Tuple[str, typing.Dict[str, typing.Union[str, typing.Callable[[str], str]]], str]] = [
+    ("transactions", {INSTANCE_LEDGER: deposit("2024-01-01", MEMBER, 1000) + purchase("2024-01-01", MEMBER)},
+     "incremental"),
+    ("new member, note, price and event", {
+        INSTANCE_LEDGER: ('\n2024-01-02 open %s\n  display_name: "Member 9999"\n' % (NEW_MEMBER,) +
+                          "\n2024-01-02 open Assets:Cash:Box EUR\n" +
+                          deposit("2024-01-02", NEW_MEMBER, 500) + purchase("2024-01-02", NEW_MEMBER) +
+                          '\n2024-01-02 note %s "Paid in cash"\n' % (NEW_MEMBER,) +
+                          "\n2024-01-02 price MATE 1.50 EUR\n" +
+                          '\n2024-01-02 event "location" "Hackerspace"\n'),
+    }, "incremental"),
+    ("new instance ledger", {
+        "ledger/dynamic.beancount": 'include "%s"\n' % (os.path.basename(NEW_LEDGER),),
+        NEW_LEDGER: purchase("2024-01-03", MEMBER),
+    }, "incremental"),
+    ("instance ledger included mid-file", {
+        "ledger/dynamic.beancount": insert_include(MERGED_LEDGER),
+        MERGED_LEDGER: purchase("2024-01-03", MEMBER),
+    }, "incremental"),
+    ("unopened account", {INSTANCE_LEDGER: txn("2024-01-04", "lost", "Expenses:Lost  1.00 EUR",
+                                               "Assets:Cash:Bar  -1.00 EUR")}, "rejected"),
+    ("unopened member", {INSTANCE_LEDGER: deposit("2024-01-04", synthetic_repo.MEMBERS_ACCT + ":Nobody", 100)},
+     "rejected"),
+    ("currency constraint", {INSTANCE_LEDGER: txn("2024-01-04", "stored", "Assets:Cash:Box  1 MATE",
+                                                  "Assets:Inventory:Bar  -1 MATE")}, "rejected"),
+    ("posting before the open", {INSTANCE_LEDGER: deposit("2024-01-01", NEW_MEMBER, 100)}, "rejected"),
+    ("backdated transaction", {INSTANCE_LEDGER: deposit("2023-06-01", MEMBER, 100)}, "full"),
+    ("balance assertion", {INSTANCE_LEDGER: "\n2024-01-05 balance Assets:Cash:Box  0.00 EUR\n"}, "full"),
+    ("failing balance assertion", {INSTANCE_LEDGER: "\n2024-01-05 balance Assets:Cash:Box  1.00 EUR\n"},
+     "rejected"),
+    ("option", {INSTANCE_LEDGER: '\noption "operating_currency" "MATE"\n' + deposit("2024-01-05", MEMBER, 100)},
+     "full"),
+    ("close", {INSTANCE_LEDGER: "\n2024-01-06 close Assets:Cash:Box\n"}, "full"),
+    ("posting after the close", {INSTANCE_LEDGER: txn("2024-01-07", "boxed", "Assets:Cash:Box  1.00 EUR",
+                                                      "Assets:Cash:Bar  -1.00 EUR")}, "rejected"),
+    ("after all that", {INSTANCE_LEDGER: deposit("2024-01-07", MEMBER, 200) + purchase("2024-01-07", NEW_MEMBER)},
+     "incremental"),
+]
+
+
+@contextlib.contextmanager
+def quiet():
+    """Hide what backtab prints while it works"""
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def git(cwd: str, *args: str):
+    subprocess.run(["git"] + list(args), cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+
+
+def push_change(path: str, changes: typing.Dict, message: str):
+    for filename, change in changes.items():
+        if callable(change):
+            with open(os.path.join(path, filename), "rt") as f:
+                text = change(f.read())
+            with open(os.path.join(path, filename), "wt") as f:
+                f.write(text)
+        else:
+            with open(os.path.join(path, filename), "at") as f:
+                f.write(change)
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", message)
+    git(path, "push", "-q")
+
+
+def take_back(path: str):
+    git(path, "reset", "-q", "--hard", "HEAD~1")
+    git(path, "push", "-q", "--force")
+
+
+def describe(repo: data_repo.RepoData) -> typing.Dict:
+    """Everything about the state that has to be the same however it was
+    loaded"""
+    with quiet():
+        state = repo.load_history()
+    return {
+        "accounts": [(name, member.account, member.display_name, member.balance_json())
+                     for name, member in state.accounts.items()],
+        "stats": {day: (day_stats.products, day_stats.paybacks) for day, day_stats in state.stats.items()},
+        "history": state.history,
+        "ledger_accounts": state.ledger_accounts,
+        "last_date": state.last_date,
+    }
+
+
+def load(path: str, snapshot: bool) -> data_repo.RepoData:
+    repo = data_repo.RepoData(repo_path=path)
+    if not snapshot and os.path.exists(repo.snapshot_path):
+        os.unlink(repo.snapshot_path)
+    with quiet():
+        repo.load_data()
+    return repo
+
+
+def compare(name: str, expected: typing.Dict, actual: typing.Dict) -> typing.List[str]:
+    return ["%s differs from a full load (%s)" % (field, name)
+            for field in expected if expected[field] != actual[field]]
+
+
+@click.command()
+@click.option("--members", default=30)
+@click.option("--txns", default=2000, help="Transactions in the generated ledger")
+def main(members, txns):
+    failures = []
+    with tempfile.TemporaryDirectory() as path:
+        remote_path, data_path = synthetic_repo.make_remote(path, members=members, txns=txns, instances=2)
+        other_path = os.path.join(path, "other")
+        reference_path = os.path.join(path, "reference")
+        synthetic_repo.clone(remote_path, other_path)
+        synthetic_repo.clone(remote_path, reference_path)
+        repo = load(data_path, snapshot=False)
+
+        for description, changes, expected in CASES:
+            push_change(other_path, changes, description)
+            history_id = repo.state.history_id
+            try:
+                with quiet():
+                    repo.pull_changes()
+                outcome = "incremental" if repo.state.history_id == history_id else "full"
+            except data_repo.UpdateFailed:
+                outcome = "rejected"
+                take_back(other_path)
+                with quiet():
+                    repo.pull_changes()
+            print("%-35s %s" % (description, outcome))
+            if outcome != expected:
+                # The cases after it build on this one
+                failures.append("%s: expected %s, got %s" % (description, expected, outcome))
+                break
+
+            git(reference_path, "pull", "-q")
+            full = describe(load(reference_path, snapshot=False))
+            failures.extend(compare(description, full, describe(repo)))
+            failures.extend(compare(description + ", from the snapshot", full, describe(load(data_path, True))))
+            # Loading the snapshot took over the history log
+            repo = load(data_path, snapshot=True)
+
+    for failure in failures:
+        print("FAILED: %s" % (failure,))
+    if failures:
+        sys.exit(1)
+    print("All reloads match a full load")
+
+
+if __name__ == "__main__":
+    main()
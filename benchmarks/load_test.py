@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# End-to-end load test: starts backtab-server on a synthetic data repo
+# cloned from a local bare remote (see synthetic_repo.py), and has a
+# number of simulated terminals poll /accounts and buy products, the way
+# tab-ui does. With --servers 2, a second instance with its own clone
+# pushes to the same remote, which is where push conflicts come from.
+#
+# At the end it reports throughput and latencies per request type, push
+# conflicts (as counted by the servers' /admin/metrics), and checks that
+# every acknowledged purchase made it to the remote.
+#
+# Usage: python benchmarks/load_test.py [--servers N] [--terminals N]
+#            [--duration SECONDS] [--buy-ratio R]
+
+import json
+import os.path
+import random
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+import urllib.error
+import urllib.request
+
+import click
+
+import synthetic_repo
+
+BASE_PORT = 14903
+
+
+class Server:
+    """A backtab-server process with its own clone of the remote"""
+    port: int
+    data_path: str
+    process: subprocess.Popen
+
+    def __init__(self, path: str, index: int, remote_path: str, data_path: str,
+                 commit_delay: float, http_server: str, startup: str = "deferred"):
+        self.port = BASE_PORT + index
+        self.data_path = data_path
+        if not os.path.exists(data_path):
+            synthetic_repo.clone(remote_path, data_path)
+        config_path = os.path.join(path, "server%d.yml" % (index,))
+        with open(config_path, "wt") as f:
+            f.write("http:\n"
+                    "  listen: 127.0.0.1\n"
+                    "  port: %d\n"
+                    "  server: %s\n"
+                    "datadir: %s\n"
+                    "slowdown: 0\n"
+                    "startup: %s\n"
+                    "commit:\n"
+                    "  max_delay: %s\n" % (self.port, http_server, data_path, startup, commit_delay))
+        self.log_path = os.path.join(path, "server%d.log" % (index,))
+        with open(self.log_path, "wt") as log:
+            self.process = subprocess.Popen(
+                [sys.executable, "-m", "backtab.server", "-c", config_path],
+                stdout=log, stderr=subprocess.STDOUT)
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%d/api/v1" % (self.port,)
+
+    def wait_ready(self, timeout: float = 120):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("Server exited; see %s" % (self.log_path,))
+            try:
+                # /ping answers before the state is loaded
+                urllib.request.urlopen(self.url + "/accounts", timeout=1).read()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError("Server didn't come up; see %s" % (self.log_path,))
+
+    def metrics(self) -> typing.Dict[str, float]:
+        """The server's counters, keyed by the sample as it appears in the
+        exposition format (name plus labels)"""
+        text = urllib.request.urlopen(self.url + "/admin/metrics").read().decode("utf-8")
+        samples = {}
+        for line in text.splitlines():
+            if line and not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        return samples
+
+    def stop(self):
+        # SIGTERM makes the server commit and push what's pending
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class Results:
+    _lock: threading.Lock
+    # Latencies in seconds, by request type
+    latencies: typing.Dict[str, typing.List[float]]
+    errors: typing.Dict[str, int]
+    # Purchases the server acknowledged, per member
+    purchases: typing.Dict[str, int]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.purchases = {}
+
+    def record(self, kind: str, latency: float, ok: bool):
+        with self._lock:
+            if ok:
+                self.latencies.setdefault(kind, []).append(latency)
+            else:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def record_purchase(self, member: str):
+        with self._lock:
+            self.purchases[member] = self.purchases.get(member, 0) + 1
+
+
+def percentile(values: typing.List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def terminal(server: Server, results: Results, deadline: float, seed: int,
+             members: typing.List[str], products: typing.List[str],
+             buy_ratio: float, think_time: float):
+    """Poll the accounts and buy things until the deadline"""
+    rnd = random.Random(seed)
+    etag = None
+    while time.monotonic() < deadline:
+        request = urllib.request.Request(server.url + "/accounts")
+        if etag is not None:
+            request.add_header("If-None-Match", etag)
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                etag = response.headers.get("ETag")
+            ok = True
+        except urllib.error.HTTPError as e:
+            # Not modified counts as a successful poll
+            ok = e.code == 304
+        except OSError:
+            ok = False
+        results.record("accounts", time.perf_counter() - start, ok)
+
+        if rnd.random() < buy_ratio:
+            member = rnd.choice(members)
+            body = json.dumps({
+                "member": member,
+                "products": {rnd.choice(products): rnd.choice([1, 1, 2])},
+            }).encode("utf-8")
+            request = urllib.request.Request(server.url + "/txn/buy", data=body,
+                                             headers={"Content-Type": "application/json"})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+                ok = True
+            except OSError:
+                ok = False
+            results.record("buy", time.perf_counter() - start, ok)
+            if ok:
+                results.record_purchase(member)
+        time.sleep(think_time * rnd.uniform(0.5, 1.5))
+
+
+def count_remote_purchases(remote_path: str, path: str) -> typing.Dict[str, int]:
+    """Count the purchases per member that reached the remote, leaving out
+    the ones the generator put there"""
+    check_path = os.path.join(path, "check")
+    synthetic_repo.clone(remote_path, check_path)
+    counts = {}
+    ledger_dir = os.path.join(check_path, "ledger")
+    for filename in os.listdir(ledger_dir):
+        if filename.startswith("bench") or filename == "dynamic.beancount":
+            continue
+        with open(os.path.join(ledger_dir, filename), "rt") as f:
+            for match in re.finditer(r'^  Liabilities:Bar:Members:(\S+)\s+-?[0-9.]+ EUR$',
+                                     f.read(), re.MULTILINE):
+                counts[match.group(1)] = counts.get(match.group(1), 0) + 1
+    return counts
+
+
+@click.command()
+@click.option("--servers", default=1, help="backtab instances pushing to the same remote")
+@click.option("--terminals", default=8, help="Simulated terminals, spread over the servers")
+@click.option("--duration", default=30.0, help="Seconds to run for")
+@click.option("--buy-ratio", default=0.3, help="Fraction of polls that are followed by a purchase")
+@click.option("--think-time", default=0.1, help="Average seconds a terminal waits between polls")
+@click.option("--commit-delay", default=1.0, help="The servers' commit.max_delay")
+@click.option("--http-server", default="threaded", help="The servers' http.server")
+@click.option("--members", default=300)
+@click.option("--txns", default=20000, help="Transactions in the generated ledger")
+@click.option("--keep", is_flag=True, help="Keep the repos and server logs afterwards")
+def main(servers, terminals, duration, buy_ratio, think_time, commit_delay, http_server,
+         members, txns, keep):
+    path = tempfile.mkdtemp(prefix="backtab-load-")
+    print("Generating data repo in %s" % (path,))
+    remote_path, data_path = synthetic_repo.make_remote(path, members=members, txns=txns)
+    member_names = synthetic_repo.member_names(members)
+    # Only the purchase code paths are of interest, so stick to a few
+    # products
+    products = [product["currency"] for product in synthetic_repo.generate_products(10)]
+
+    instances = []
+    try:
+        for i in range(servers):
+            instances.append(Server(path, i, remote_path,
+                                    data_path if i == 0 else os.path.join(path, "data%d" % (i,)),
+                                    commit_delay, http_server))
+        for instance in instances:
+            instance.wait_ready()
+        print("Started %d server(s); running %d terminals for %ds" % (servers, terminals, duration))
+
+        results = Results()
+        deadline = time.monotonic() + duration
+        threads = [
+            threading.Thread(target=terminal, args=(
+                instances[i % servers], results, deadline, i,
+                member_names, products, buy_ratio, think_time))
+            for i in range(terminals)
+        ]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+        samples = [instance.metrics() for instance in instances]
+    finally:
+        for instance in instances:
+            instance.stop()
+
+    print()
+    print("%-10s %8s %8s %10s %10s %10s" % ("request", "count", "errors", "req/s", "p50 ms", "p99 ms"))
+    for kind in ["accounts", "buy"]:
+        latencies = results.latencies.get(kind, [])
+        print("%-10s %8d %8d %10.1f %10.2f %10.2f" % (
+            kind, len(latencies), results.errors.get(kind, 0), len(latencies) / elapsed,
+            percentile(latencies, 0.5) * 1000 if latencies else 0,
+            percentile(latencies, 0.99) * 1000 if latencies else 0))
+
+    print()
+    for i, metrics in enumerate(samples):
+        pushes = sum(value for name, value in metrics.items()
+                     if name.startswith("backtab_pushes_total"))
+        retries = metrics.get("backtab_push_retries_total", 0)
+        print("server %d: %d pushes, %d push conflicts (%.1f%%)" % (
+            i, pushes, retries, 100 * retries / pushes if pushes else 0))
+
+    # Every purchase posts exactly one EUR leg to the member
+    pushed = count_remote_purchases(remote_path, path)
+    lost = {member: count - pushed.get(member, 0)
+            for member, count in results.purchases.items()
+            if count != pushed.get(member, 0)}
+    print()
+    if lost:
+        print("MISMATCH between acknowledged and pushed purchases: %r" % (lost,))
+    else:
+        print("All %d acknowledged purchases reached the remote" % (sum(results.purchases.values()),))
+
+    if keep:
+        print("Repos and logs are in %s" % (path,))
+    else:
+        import shutil
+        shutil.rmtree(path)
+    if lost:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# Generate a synthetic data repo shaped like a real one: a product
+# catalog in static/products.yml, the member accounts in bartab.beancount,
+# and the transactions spread over several instance ledgers included from
+# ledger/dynamic.beancount, as if written by that many backtab instances.
+#
+# Usage: python benchmarks/synthetic_repo.py OUTPUT_DIR [--members N]
+#            [--products N] [--txns N] [--instances N] [--remote]
+#
+# With --remote, OUTPUT_DIR gets a bare repo (remote.git) and a clone of
+# it (data), like backtab-init-repo sets up in test mode.
+
+import datetime
+import os
+import random
+import subprocess
+import typing
+
+import click
+
+MEMBERS_ACCT = "Liabilities:Bar:Members"
+PAYBACK_ACCT = "Liabilities:Bar:Payback"
+PRODUCTS = ["CM", "COKE", "MATE", "BEER", "CHIPS", "WATER"]
+
+
+def member_names(members: int) -> typing.List[str]:
+    return ["Member%04d" % (i,) for i in range(members)]
+
+
+def generate_products(count: int, seed: int = 0) -> typing.List[typing.Dict]:
+    """Product definitions as they appear in products.yml"""
+    rnd = random.Random(seed)
+    products = []
+    for i in range(count):
+        currency = PRODUCTS[i] if i < len(PRODUCTS) else "PROD%03d" % (i,)
+        price = rnd.randint(2, 12) * 25
+        product = {
+            "name": currency.title(),
+            "currency": currency,
+            "price": "%d.%02d" % divmod(price, 100),
+            "event_price": "%d.%02d" % divmod(price + 50, 100),
+            "category": rnd.choice(["drinks", "snacks", "misc"]),
+            "visible": True,
+        }
+        if i % 5 == 0:
+            # Some products are sold on behalf of a member
+            product["payback"] = {
+                "account": "%s:Seller%d" % (PAYBACK_ACCT, i),
+                "amount": "0.%02d" % (price // 4 % 100,),
+            }
+        products.append(product)
+    return products
+
+
+def _cents(cents: int) -> str:
+    sign = "-" if cents < 0 else ""
+    return "%s%d.%02d" % ((sign,) + divmod(abs(cents), 100))
+
+
+def synthetic_entries(names: typing.List[str],
+                      products: typing.List[typing.Dict],
+                      txns: int,
+                      seed: int = 0) -> typing.Iterator[str]:
+    """Transactions in the format backtab writes them: mostly purchases,
+    with some deposits and transfers mixed in"""
+    rnd = random.Random(seed)
+    timestamp = datetime.datetime(2015, 1, 1, 12)
+    for i in range(txns):
+        timestamp += datetime.timedelta(seconds=rnd.randint(1, 600))
+        name = rnd.choice(names)
+        member = "%s:%s" % (MEMBERS_ACCT, name)
+        kind = rnd.random()
+        header = '%s txn "%%s"\n  timestamp: "%s"\n  type: "%%s"\n' % (timestamp.date(), timestamp)
+        if kind < 0.12:
+            amount = rnd.choice([500, 1000, 2000, 5000])
+            yield (header % ("%s deposited €%s" % (name, _cents(amount)), "deposit") +
+                   "  %s  %s EUR\n  Assets:Cash:Bar  %s EUR\n" % (member, _cents(-amount), _cents(amount)))
+        elif kind < 0.2:
+            amount = rnd.randint(1, 20) * 50
+            payee = rnd.choice(names)
+            yield (header % ("%s gave %s a gift of €%s" % (name, payee, _cents(amount)), "transfer") +
+                   "  %s  %s EUR\n  %s:%s  %s EUR\n" % (member, _cents(amount), MEMBERS_ACCT, payee,
+                                                         _cents(-amount)))
+        else:
+            lines = []
+            charge = 0
+            count = 0
+            paybacks = {}
+            for product in rnd.sample(products, rnd.choice([1, 1, 1, 2, 3])):
+                qty = rnd.choice([1, 1, 1, 2])
+                count += qty
+                charge += int(product["price"].replace(".", "")) * qty
+                lines.append("  Assets:Inventory:Bar  %d %s\n" % (-qty, product["currency"]))
+                lines.append("  %s  %d %s\n" % (member, qty, product["currency"]))
+                if "payback" in product:
+                    account = product["payback"]["account"]
+                    paybacks[account] = (paybacks.get(account, 0) +
+                                         int(product["payback"]["amount"].replace(".", "")) * qty)
+            lines.append("  %s  %s EUR\n" % (member, _cents(charge)))
+            income = charge
+            for account, amount in paybacks.items():
+                lines.append("  %s  %s EUR\n" % (account, _cents(-amount)))
+                income -= amount
+            lines.append("  Income:Bar  %s EUR\n" % (_cents(-income),))
+            yield (header % ("%s bought %d items for €%s" % (name, count, _cents(charge)), "purchase") +
+                   "".join(lines))
+
+
+def synthetic_ledger(members: int, txns: int, seed: int = 0) -> str:
+    """A complete ledger in a single string"""
+    names = member_names(members)
+    products = generate_products(len(PRODUCTS), seed)
+    return "\n".join([ledger_header(names, products)] +
+                     list(synthetic_entries(names, products, txns, seed)))
+
+
+def ledger_header(names: typing.List[str], products: typing.List[typing.Dict]) -> str:
+    lines = ['option "operating_currency" "EUR"', ""]
+    for account in ["Assets:Cash:Bar", "Assets:Inventory:Bar", "Income:Bar"]:
+        lines.append("1970-01-01 open %s" % (account,))
+    for product in products:
+        if "payback" in product:
+            lines.append("1970-01-01 open %s" % (product["payback"]["account"],))
+    for i, name in enumerate(names):
+        lines.append("1970-01-01 open %s:%s" % (MEMBERS_ACCT, name))
+        if i % 2 == 0:
+            lines.append('  display_name: "%s"' % (name.replace("Member", "Member "),))
+    return "\n".join(lines) + "\n"
+
+
+def generate_repo(path: str,
+                  members: int = 300,
+                  products: int = 30,
+                  txns: int = 20000,
+                  instances: int = 4,
+                  seed: int = 0):
+    """Write a data repo into path, which must not exist yet"""
+    import yaml
+
+    names = member_names(members)
+    product_defs = generate_products(products, seed)
+    os.makedirs(os.path.join(path, "static"))
+    os.makedirs(os.path.join(path, "ledger"))
+    with open(os.path.join(path, "static", "products.yml"), "wt") as f:
+        yaml.safe_dump(product_defs, f, sort_keys=False)
+    with open(os.path.join(path, "bartab.beancount"), "wt") as f:
+        f.write(ledger_header(names, product_defs))
+        f.write('\ninclude "ledger/dynamic.beancount"\n')
+
+    ledgers = []
+    for i in range(instances):
+        name = "bench%d_2015-01-01 00:00:00.000000+00:00.beancount" % (i,)
+        ledgers.append(open(os.path.join(path, "ledger", name), "wt"))
+    try:
+        for i, entry in enumerate(synthetic_entries(names, product_defs, txns, seed)):
+            ledgers[i % instances].write(entry + "\n")
+    finally:
+        for ledger in ledgers:
+            ledger.close()
+    with open(os.path.join(path, "ledger", "dynamic.beancount"), "wt") as f:
+        for ledger in ledgers:
+            f.write('include "%s"\n' % (os.path.basename(ledger.name),))
+
+
+def _git(cwd: str, *args: str):
+    subprocess.run(["git"] + list(args), cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+
+
+def _configure_identity(path: str):
+    _git(path, "config", "user.name", "backtab benchmark")
+    _git(path, "config", "user.email", "bench@example.com")
+
+
+def make_remote(path: str, **kwargs) -> typing.Tuple[str, str]:
+    """Generate a data repo, and set it up as a bare remote with a clone in
+    path; returns the paths of the remote and the clone"""
+    # git runs in different directories below
+    path = os.path.abspath(path)
+    seed_path = os.path.join(path, "seed")
+    remote_path = os.path.join(path, "remote.git")
+    data_path = os.path.join(path, "data")
+    generate_repo(seed_path, **kwargs)
+    _git(seed_path, "init", "-q")
+    _configure_identity(seed_path)
+    _git(seed_path, "add", "-A")
+    _git(seed_path, "commit", "-q", "-m", "Synthetic data repo")
+    _git(path, "clone", "-q", "--bare", seed_path, remote_path)
+    clone(remote_path, data_path)
+    return remote_path, data_path
+
+
+def clone(remote_path: str, data_path: str):
+    remote_path = os.path.abspath(remote_path)
+    data_path = os.path.abspath(data_path)
+    _git(os.path.dirname(data_path), "clone", "-q", remote_path, data_path)
+    _configure_identity(data_path)
+
+
+@click.command()
+@click.argument("output", type=click.Path(exists=False, file_okay=False))
+@click.option("--members", default=300)
+@click.option("--products", default=30)
+@click.option("--txns", default=20000)
+@click.option("--instances", default=4)
+@click.option("--seed", default=0)
+@click.option("--remote", is_flag=True, help="Set up a bare remote and a clone of it")
+def main(output, members, products, txns, instances, seed, remote):
+    kwargs = dict(members=members, products=products, txns=txns, instances=instances, seed=seed)
+    if remote:
+        remote_path, data_path = make_remote(output, **kwargs)
+        print("Remote: %s\nClone: %s" % (remote_path, data_path))
+    else:
+        generate_repo(output, **kwargs)
+        print("Data repo: %s" % (output,))
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,8 @@ setuptools.setup(
         'console_scripts': [
             "backtab-import-spacebar = backtab.dataconv:main",
             "backtab-server = backtab.server:main",
+            "backtab-checkpoint = backtab.checkpoint:main",
+            "backtab-validate = backtab.validate:main",
         ]
     },
     install_requires=[
@@ -21,4 +23,8 @@ setuptools.setup(
         "sdnotify >= 0.3.1, <0.4",
         "beancount == 2.3.5",
     ],
+    extras_require={
+        # In-process git backend
+        "dulwich": ["dulwich"],
+    },
 )
@@ -0,0 +1,266 @@
+# Checkpoints of the ledger
+#
+# Every time backtab starts, it writes to a new instance ledger that gets
+# included from ledger/dynamic.beancount, so the ledger grows with every
+# restart as well as with every transaction. A checkpoint rolls the
+# instance ledgers of instances that are gone into a single transaction
+# in ledger/checkpoint.beancount that carries every account's balance
+# forward. Their full text moves to a file in archive/, which the ledger
+# doesn't include, so that loading only has to deal with recent activity.
+#
+# An instance ledger counts as closed when a newer one from the same
+# instance exists, i.e., the instance that wrote it has been restarted
+# since. Instances are told apart by their instance_name setting, or their
+# hostname if it's unset. The newest ledger of each instance is only rolled
+# up with --include-latest, for when that instance isn't running any more.
+#
+# This runs in a clone of the data repo that has no uncommitted changes,
+# not in the data directory of a running instance; instances pick the
+# checkpoint up with their next pull.
+
+import collections
+import datetime
+import os
+import subprocess
+import sys
+import typing
+
+import beancount.core.data as bcdata
+import beancount.core.inventory as bcinv
+import beancount.loader
+import beancount.parser.parser
+import beancount.parser.printer
+import click
+
+from backtab import git
+from backtab.config import SERVER_CONFIG
+
+CHECKPOINT_FILE = "checkpoint.beancount"
+ARCHIVE_DIR = "archive"
+
+InstanceLedger = collections.namedtuple("InstanceLedger", ["filename", "instance", "started"])
+
+
+class CheckpointFailed(Exception):
+    pass
+
+
+def parse_instance_ledger_name(filename: str) -> typing.Optional[InstanceLedger]:
+    """Split the name of an instance ledger, as created by
+    RepoData.instance_ledger, into the instance name and start time"""
+    if not filename.endswith(".beancount"):
+        return None
+    instance, _, started = filename[:-len(".beancount")].rpartition("_")
+    try:
+        return InstanceLedger(filename, instance, datetime.datetime.fromisoformat(started))
+    except ValueError:
+        return None
+
+
+def read_includes(dynamic_filename: str) -> typing.List[str]:
+    includes = []
+    with open(dynamic_filename, "rt") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("include "):
+                includes.append(line[len("include "):].strip('"'))
+    return includes
+
+
+def closed_ledgers(ledgers: typing.List[InstanceLedger],
+                   include_latest: bool = False) -> typing.List[InstanceLedger]:
+    if include_latest:
+        return list(ledgers)
+    latest = {}
+    for ledger in ledgers:
+        if ledger.instance not in latest or latest[ledger.instance].started < ledger.started:
+            latest[ledger.instance] = ledger
+    return [ledger for ledger in ledgers if latest[ledger.instance] is not ledger]
+
+
+def total_balances(entries: typing.Iterable[bcdata.Directive]) -> typing.Dict[str, bcinv.Inventory]:
+    """The balance of every account after the given entries"""
+    balances = collections.defaultdict(bcinv.Inventory)
+    for entry in entries:
+        if isinstance(entry, bcdata.Transaction):
+            for posting in entry.postings:
+                balances[posting.account].add_amount(posting.units)
+    return {account: balance for account, balance in balances.items() if not balance.is_empty()}
+
+
+def load_rollable(filename: str, cutoff: datetime.date) -> typing.Tuple[typing.Optional[typing.List], str]:
+    """Parse a ledger that is to be rolled up. Returns the entries, or None
+    along with the reason it can't be rolled up"""
+    entries, errors, options = beancount.parser.parser.parse_file(filename)
+    if errors:
+        return None, "it has parse errors"
+    if options["include"]:
+        return None, "it includes other files"
+    for entry in entries:
+        if not isinstance(entry, bcdata.Transaction):
+            return None, "it contains %s entries" % (type(entry).__name__,)
+        if entry.date >= cutoff:
+            return None, "it has entries from %s" % (entry.date,)
+        if any(beancount.parser.parser.is_posting_incomplete(posting) for posting in entry.postings):
+            return None, "it has postings without amounts"
+    return entries, ""
+
+
+def checkpoint_txn(entries: typing.List[bcdata.Transaction], archive: str) -> bcdata.Transaction:
+    """A single transaction that has the same effect on every account as
+    the given ones"""
+    balances = total_balances(entries)
+    residual = bcinv.Inventory()
+    for balance in balances.values():
+        residual.add_inventory(balance)
+    if not residual.is_empty():
+        raise CheckpointFailed("Rolled up transactions don't balance: %s" % (residual,))
+
+    date = max(entry.date for entry in entries)
+    txn = bcdata.Transaction(
+        meta={"type": "checkpoint", "archive": archive},
+        date=date,
+        flag="txn",
+        payee=None,
+        narration="Checkpoint of %d transactions up to %s" % (len(entries), date),
+        tags=set(),
+        links=set(),
+        postings=[])
+    for account in sorted(balances):
+        for position in sorted(balances[account], key=lambda position: position.units.currency):
+            bcdata.create_simple_posting(txn, account, position.units.number, position.units.currency)
+    return txn
+
+
+def checkpoint(repo_path: str, cutoff: datetime.date, include_latest: bool = False,
+               dry_run: bool = False) -> bool:
+    """Roll the closed instance ledgers with no entries from cutoff on into
+    the checkpoint, and commit that. Returns whether there was anything to
+    roll up."""
+    repo = git.SubprocessGit(repo_path)
+    if repo.output("status", "--porcelain").strip():
+        raise CheckpointFailed("%s has uncommitted changes" % (repo_path,))
+
+    ledger_dir = os.path.join(repo_path, "ledger")
+    dynamic_filename = os.path.join(ledger_dir, "dynamic.beancount")
+    checkpoint_filename = os.path.join(ledger_dir, CHECKPOINT_FILE)
+
+    ledgers = [ledger for ledger in map(parse_instance_ledger_name, read_includes(dynamic_filename))
+               if ledger is not None]
+    rolled = []
+    entries = []
+    for ledger in sorted(closed_ledgers(ledgers, include_latest), key=lambda ledger: ledger.started):
+        ledger_entries, reason = load_rollable(os.path.join(ledger_dir, ledger.filename), cutoff)
+        if ledger_entries is None:
+            print("Leaving %s alone, as %s" % (ledger.filename, reason))
+            continue
+        print("Rolling up %s (%d entries)" % (ledger.filename, len(ledger_entries)))
+        rolled.append(ledger.filename)
+        entries.extend(ledger_entries)
+    if not rolled:
+        print("Nothing to checkpoint")
+        return False
+    if dry_run:
+        return True
+
+    # The previous checkpoint gets folded into the new one; its own
+    # history is in an earlier archive already
+    if os.path.exists(checkpoint_filename):
+        previous, reason = load_rollable(checkpoint_filename, datetime.date.max)
+        if previous is None:
+            raise CheckpointFailed("Can't read the previous checkpoint, as %s" % (reason,))
+        entries.extend(previous)
+
+    before, errors, _ = beancount.loader.load_file(os.path.join(repo_path, "bartab.beancount"))
+    if errors:
+        raise CheckpointFailed("The ledger doesn't load cleanly before the checkpoint")
+    before = total_balances(before)
+
+    archive_name = "ledger-%s.beancount" % (max(entry.date for entry in entries),)
+    os.makedirs(os.path.join(repo_path, ARCHIVE_DIR), exist_ok=True)
+    suffix = 1
+    while os.path.exists(os.path.join(repo_path, ARCHIVE_DIR, archive_name)):
+        suffix += 1
+        archive_name = "ledger-%s.%d.beancount" % (max(entry.date for entry in entries), suffix)
+    archive = os.path.join(ARCHIVE_DIR, archive_name)
+    txn = checkpoint_txn(entries, archive)
+
+    try:
+        with open(os.path.join(repo_path, archive), "wt") as f:
+            f.write("; Instance ledgers rolled up into ledger/%s\n"
+                    "; This file is not part of the ledger\n" % (CHECKPOINT_FILE,))
+            for filename in ([CHECKPOINT_FILE] if os.path.exists(checkpoint_filename) else []) + rolled:
+                f.write("\n; ---- ledger/%s\n" % (filename,))
+                with open(os.path.join(ledger_dir, filename), "rt") as ledger:
+                    f.write(ledger.read())
+        with open(checkpoint_filename, "wt") as f:
+            f.write("; Balances carried forward from the ledgers in %s\n\n" % (archive,))
+            f.write(beancount.parser.printer.format_entry(txn))
+
+        with open(dynamic_filename, "rt") as f:
+            lines = f.readlines()
+        checkpoint_include = 'include "%s"\n' % (CHECKPOINT_FILE,)
+        removed = {'include "%s"\n' % (filename,) for filename in rolled} | {checkpoint_include}
+        with open(dynamic_filename, "wt") as f:
+            f.write(checkpoint_include)
+            f.writelines(line for line in lines if line not in removed)
+        for filename in rolled:
+            os.unlink(os.path.join(ledger_dir, filename))
+
+        after, errors, _ = beancount.loader.load_file(os.path.join(repo_path, "bartab.beancount"))
+        if errors:
+            beancount.parser.printer.print_errors(errors)
+            raise CheckpointFailed("The ledger doesn't load cleanly after the checkpoint")
+        if total_balances(after) != before:
+            raise CheckpointFailed("The checkpoint changed some balances")
+
+        repo.add("ledger", ARCHIVE_DIR)
+        repo.commit("Checkpoint of %d instance ledgers up to %s" % (len(rolled), txn.date))
+    except Exception:
+        repo.reset_hard("HEAD")
+        repo.run("clean", "-fdq", "--", "ledger", ARCHIVE_DIR)
+        raise
+    return True
+
+
+@click.command()
+@click.option('-c', "--config-file", default="config.yml",
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help="Server config to take the datadir from")
+@click.option("--repo", type=click.Path(file_okay=False, resolve_path=True, exists=True),
+              help="The data repo clone to work in; defaults to the datadir from the config")
+@click.option("--cutoff", type=click.DateTime(formats=["%Y-%m-%d"]), default=None,
+              help="Only roll up ledgers without entries from this date on; defaults to today")
+@click.option("--include-latest", is_flag=True,
+              help="Also roll up the newest ledger of each instance. Only use this when no instance is running")
+@click.option("--push", is_flag=True, help="Push the checkpoint, redoing it if the remote has moved on")
+@click.option("--dry-run", is_flag=True, help="Only list what would be rolled up")
+def main(config_file, repo, cutoff, include_latest, push, dry_run):
+    if repo is None:
+        SERVER_CONFIG.load_from_config(config_file)
+        repo = SERVER_CONFIG.DATA_DIR
+    cutoff = cutoff.date() if cutoff is not None else datetime.date.today()
+
+    for attempt in range(3):
+        try:
+            if not checkpoint(repo, cutoff, include_latest=include_latest, dry_run=dry_run):
+                return
+        except CheckpointFailed as e:
+            print("Checkpoint failed: %s" % (e,))
+            sys.exit(1)
+        if not push or dry_run:
+            return
+        try:
+            git.SubprocessGit(repo).run("push")
+            return
+        except subprocess.SubprocessError:
+            # Someone else pushed in the meantime; start over from theirs
+            print("Push failed; redoing the checkpoint on top of the remote")
+            git.SubprocessGit(repo).run("fetch")
+            git.SubprocessGit(repo).reset_hard("@{upstream}")
+    print("Giving up on pushing the checkpoint")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,8 +14,21 @@ class ConfigData:
     DATA_DIR: str = os.path.join(os.getcwd(), "mut_data")
     PORT: int = 80
     LISTEN_ADDR: str = "localhost"
+    HTTP_SERVER: str = "threaded"
+    HTTP_WORKERS: int = 16
     SLOWDOWN: float = 0.1
     EVENT_MODE: bool = False
+    COMMIT_MAX_BATCH: int = 50
+    COMMIT_MAX_DELAY: float = 5.0
+    LEDGER_FSYNC: str = "txn"
+    LEDGER_FSYNC_INTERVAL: float = 1.0
+    GIT_BACKEND: str = "auto"
+    STARTUP: str = "deferred"
+    SYNC_INTERVAL: float = 60.0
+    IDEMPOTENCY_TTL: float = 86400.0
+    IDEMPOTENCY_MAX_KEYS: int = 1000
+    # Names the instance ledgers; the hostname if unset
+    INSTANCE_NAME: typing.Optional[str] = None
 
     def load_from_config(self, configPath: str):
         import yaml
@@ -24,20 +37,56 @@ class ConfigData:
         self.DATA_DIR = get_path(config, "datadir", default=self.DATA_DIR)
         self.PORT = get_path(config, "http", "port", default=self.PORT)
         self.LISTEN_ADDR = get_path(config, "http", "listen", default=self.LISTEN_ADDR)
+        self.HTTP_SERVER = get_path(config, "http", "server", default=self.HTTP_SERVER)
+        self.HTTP_WORKERS = get_path(config, "http", "workers", default=self.HTTP_WORKERS)
         self.SLOWDOWN = get_path(config, "slowdown", default=self.SLOWDOWN)
         self.EVENT_MODE = get_path(config, "event_mode", default=self.EVENT_MODE)
+        self.COMMIT_MAX_BATCH = get_path(config, "commit", "max_batch", default=self.COMMIT_MAX_BATCH)
+        self.COMMIT_MAX_DELAY = get_path(config, "commit", "max_delay", default=self.COMMIT_MAX_DELAY)
+        self.LEDGER_FSYNC = get_path(config, "ledger", "fsync", default=self.LEDGER_FSYNC)
+        self.LEDGER_FSYNC_INTERVAL = get_path(config, "ledger", "fsync_interval", default=self.LEDGER_FSYNC_INTERVAL)
+        self.GIT_BACKEND = get_path(config, "git", "backend", default=self.GIT_BACKEND)
+        self.STARTUP = get_path(config, "startup", default=self.STARTUP)
+        self.SYNC_INTERVAL = get_path(config, "sync", "interval", default=self.SYNC_INTERVAL)
+        self.IDEMPOTENCY_TTL = get_path(config, "idempotency", "ttl", default=self.IDEMPOTENCY_TTL)
+        self.IDEMPOTENCY_MAX_KEYS = get_path(config, "idempotency", "max_keys", default=self.IDEMPOTENCY_MAX_KEYS)
+        self.INSTANCE_NAME = get_path(config, "instance_name", default=self.INSTANCE_NAME)
 
         print("Config:\n"
               "  DATA_DIR: %(DATA_DIR)s\n"
               "  PORT: %(PORT)s\n"
               "  LISTEN_ADDR: %(LISTEN_ADDR)s\n"
+              "  HTTP_SERVER: %(HTTP_SERVER)s\n"
+              "  HTTP_WORKERS: %(HTTP_WORKERS)s\n"
               "  SLOWDOWN: %(SLOWDOWN)s\n"
-              "  EVENT_MODE: %(EVENT_MODE)s\n" % dict(
+              "  EVENT_MODE: %(EVENT_MODE)s\n"
+              "  COMMIT_MAX_BATCH: %(COMMIT_MAX_BATCH)s\n"
+              "  COMMIT_MAX_DELAY: %(COMMIT_MAX_DELAY)s\n"
+              "  LEDGER_FSYNC: %(LEDGER_FSYNC)s\n"
+              "  LEDGER_FSYNC_INTERVAL: %(LEDGER_FSYNC_INTERVAL)s\n"
+              "  GIT_BACKEND: %(GIT_BACKEND)s\n"
+              "  STARTUP: %(STARTUP)s\n"
+              "  SYNC_INTERVAL: %(SYNC_INTERVAL)s\n"
+              "  IDEMPOTENCY_TTL: %(IDEMPOTENCY_TTL)s\n"
+              "  IDEMPOTENCY_MAX_KEYS: %(IDEMPOTENCY_MAX_KEYS)s\n"
+              "  INSTANCE_NAME: %(INSTANCE_NAME)s\n" % dict(
             DATA_DIR=self.DATA_DIR,
             PORT=self.PORT,
             LISTEN_ADDR=self.LISTEN_ADDR,
+            HTTP_SERVER=self.HTTP_SERVER,
+            HTTP_WORKERS=self.HTTP_WORKERS,
             SLOWDOWN=self.SLOWDOWN,
             EVENT_MODE=self.EVENT_MODE,
+            COMMIT_MAX_BATCH=self.COMMIT_MAX_BATCH,
+            COMMIT_MAX_DELAY=self.COMMIT_MAX_DELAY,
+            LEDGER_FSYNC=self.LEDGER_FSYNC,
+            LEDGER_FSYNC_INTERVAL=self.LEDGER_FSYNC_INTERVAL,
+            GIT_BACKEND=self.GIT_BACKEND,
+            STARTUP=self.STARTUP,
+            SYNC_INTERVAL=self.SYNC_INTERVAL,
+            IDEMPOTENCY_TTL=self.IDEMPOTENCY_TTL,
+            IDEMPOTENCY_MAX_KEYS=self.IDEMPOTENCY_MAX_KEYS,
+            INSTANCE_NAME=self.INSTANCE_NAME,
         ))
 
 SERVER_CONFIG = ConfigData()
@@ -1,36 +1,458 @@
+from backtab import git, metrics
 from backtab.config import SERVER_CONFIG
+from backtab.events import BROKER
+import array
 import contextlib
 import datetime
 import decimal
+import glob
 import os.path
+import re
 import subprocess
 import threading
+import time
 import typing
 import beancount.core.account as bcacct
 import beancount.core.data as bcdata
 import beancount.core.inventory as bcinv
 import beancount.core.interpolate as bcinterp
-import beancount.loader
-import beancount.parser.printer
-import beancount.query.query
+import beancount.parser.parser
 import collections
 import io
+import json
+import pickle
 import traceback
 
+# Concurrency model:
+#
+# HTTP requests may be served from several threads at once, alongside the
+# committer thread. Anything that changes the repo or the live state
+# (apply_txn, pull_changes, load_data, commits) holds repo_lock. The one
+# exception is the parse of a full reload after a pull, which takes long
+# enough that transactions carry on meanwhile (see _merge_upstream).
+#
+# Readers don't take the lock, so that they don't have to wait for a pull
+# or a reload. Instead, the live state is a RepoState that is never
+# modified once published: writers build an updated copy and swap it in
+# as RepoData.state in one assignment. A reader that fetches REPO_DATA.state
+# once and works from that always sees a consistent view.
 repo_lock = threading.RLock()
+# How deeply each thread has nested transaction(); only the outermost one
+# gets counted in the lock metrics
+_lock_depth = threading.local()
 
 CASH_ACCT = "Assets:Cash:Bar"
+INVENTORY_ACCT = "Assets:Inventory:Bar"
+INCOME_ACCT = "Income:Bar"
+MEMBERS_ACCT = "Liabilities:Bar:Members"
+
+INCLUDE_RE = re.compile(r'^include\s+"[^"]*"\s*$')
+
+# Files that every instance appends lines to. When two instances do that
+# at the same time, the lines from both sides belong in the merge.
+UNION_MERGE_FILES = ["ledger/dynamic.beancount"]
+
+# The format of RepoData snapshots. Bump it whenever what goes into them
+# changes; a snapshot of another version doesn't get used.
+SNAPSHOT_VERSION = 1
 
 
 @contextlib.contextmanager
 def transaction():
     """Get the repo lock. Designed to be used with a with statement"""
+    depth = getattr(_lock_depth, "value", 0)
+    if depth > 0:
+        with repo_lock:
+            yield
+        return
+
+    start = time.perf_counter()
     with repo_lock:
-        yield
+        acquired = time.perf_counter()
+        metrics.LOCK_WAIT_SECONDS.observe(acquired - start)
+        _lock_depth.value = 1
+        try:
+            yield
+        finally:
+            _lock_depth.value = 0
+            metrics.LOCK_HOLD_SECONDS.observe(time.perf_counter() - acquired)
+
+
+class Cents(int):
+    """An amount of euros, stored as an integer number of cents. Arithmetic
+    on it is exact; it only becomes a Decimal when it gets written to the
+    ledger"""
+    __slots__ = ()
+
+    def __str__(self):
+        return "%s%d.%02d" % ("-" if self < 0 else "", abs(self) // 100, abs(self) % 100)
+
+    def __repr__(self):
+        return "Cents(%s)" % (str(self),)
+
+    def __add__(self, other):
+        return Cents(int(self) + other)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return Cents(int(self) - other)
+
+    def __rsub__(self, other):
+        return Cents(other - int(self))
+
+    def __neg__(self):
+        return Cents(-int(self))
+
+    def __mul__(self, other: int):
+        return Cents(int(self) * other)
+
+    __rmul__ = __mul__
+
+    def to_decimal(self) -> decimal.Decimal:
+        return decimal.Decimal(int(self)).scaleb(-2)
+
+
+def parse_price(price_str: typing.Union[float, str, decimal.Decimal, int]) -> Cents:
+    """Parse an amount of euros. Raises ValueError if it isn't a whole
+    number of cents"""
+    if isinstance(price_str, float):
+        # The shortest representation, as written in the JSON or YAML
+        price_str = repr(price_str)
+    cents = decimal.Decimal(price_str) * 100
+    if not cents.is_finite() or cents != cents.to_integral_value():
+        raise ValueError("Not a whole number of cents", price_str)
+    return Cents(cents)
+
+
+def is_bar_account(account: str) -> bool:
+    """Whether the account is one that gets loaded as a Member"""
+    return bcacct.parent(account) == MEMBERS_ACCT or account == CASH_ACCT
+
+
+def aggregate_balances(entries: typing.Iterable[bcdata.Directive]) \
+        -> typing.Tuple[typing.Dict[str, bcinv.Inventory], typing.List[bcdata.Open]]:
+    """Compute the balances of all bar accounts in a single pass over the
+    entries. Returns the balances by account along with the Open entries
+    of the bar accounts, in ledger order."""
+    balances = {}
+    opens = []
+    # Cache of is_bar_account; there are far fewer accounts than postings
+    bar_accounts = {}
+    for entry in entries:
+        if isinstance(entry, bcdata.Transaction):
+            for posting in entry.postings:
+                account = posting.account
+                is_bar = bar_accounts.get(account)
+                if is_bar is None:
+                    is_bar = bar_accounts[account] = is_bar_account(account)
+                if not is_bar:
+                    continue
+                inventory = balances.get(account)
+                if inventory is None:
+                    inventory = balances[account] = bcinv.Inventory()
+                inventory.add_position(posting)
+        elif isinstance(entry, bcdata.Open):
+            if is_bar_account(entry.account):
+                opens.append(entry)
+            else:
+                print("Didn't load %s as it's no bar account" % (entry.account,))
+    return balances, opens
+
+
+def build_members(entries: typing.Iterable[bcdata.Directive],
+                  product_currencies: typing.Dict[str, int]) \
+        -> typing.Tuple[typing.Dict[str, "Member"], typing.Dict[str, "Member"]]:
+    """Build the members from a loaded ledger. Returns them keyed by
+    internal name, and keyed by account"""
+    accounts = {}
+    accounts_raw = {}
+    balances, opens = aggregate_balances(entries)
+    for entry in opens:
+        acct = Member(entry.account, item_curencies=product_currencies)
+        if "display_name" in entry.meta:
+            acct.display_name = entry.meta["display_name"]
+        if acct.account in balances:
+            acct.load_inventory(balances[acct.account])
+        accounts[acct.internal_name] = acct
+        accounts_raw[acct.account] = acct
+    return accounts, accounts_raw
+
+
+# When an account can be posted to, as far as beancount's checks go.
+# close: the date of the Close, or None while it's open
+# currencies: the currencies the Open allows, or None for any
+LedgerAccount = collections.namedtuple("LedgerAccount", ["open", "close", "currencies"])
+
+
+def ledger_accounts(entries: typing.Iterable[bcdata.Directive]) -> typing.Dict[str, LedgerAccount]:
+    """Collect the Open and Close entries of every account in the ledger"""
+    accounts = {}
+    for entry in entries:
+        if isinstance(entry, bcdata.Open):
+            accounts[entry.account] = LedgerAccount(
+                entry.date, None, tuple(entry.currencies) if entry.currencies else None)
+        elif isinstance(entry, bcdata.Close) and entry.account in accounts:
+            accounts[entry.account] = accounts[entry.account]._replace(close=entry.date)
+    return accounts
+
+
+def can_post(account: typing.Optional[LedgerAccount], date: datetime.date,
+             currency: typing.Optional[str] = None) -> bool:
+    """Whether beancount accepts a posting to the account on that date"""
+    if account is None or date < account.open:
+        return False
+    if account.close is not None and date > account.close:
+        return False
+    return currency is None or account.currencies is None or currency in account.currencies
+
+
+# One transaction in the history of a member, as seen from their account.
+# changes: (currency, units) pairs for the member's account, with units in
+#    cents for EUR and a count for everything else, like in a Leg
+HistoryEntry = collections.namedtuple("HistoryEntry", ["date", "timestamp", "type", "narration", "changes"])
+
+
+def _units(number: decimal.Decimal, currency: str) -> int:
+    if currency == "EUR":
+        return int((number * 100).to_integral_value(decimal.ROUND_HALF_EVEN))
+    return int(number.to_integral_value(decimal.ROUND_HALF_EVEN))
+
+
+def history_entries(entries: typing.Iterable[bcdata.Directive],
+                    accounts: typing.Container[str]) -> typing.List[typing.Tuple[str, HistoryEntry]]:
+    """The history entries for the transactions among entries, for each of
+    accounts that they post to, in order, along with the account"""
+    added = []
+    for entry in entries:
+        if not isinstance(entry, bcdata.Transaction):
+            continue
+        changes = {}
+        for posting in entry.postings:
+            if posting.account not in accounts:
+                continue
+            units = changes.setdefault(posting.account, {})
+            currency = posting.units.currency
+            units[currency] = units.get(currency, 0) + _units(posting.units.number, currency)
+        if not changes:
+            continue
+        date = entry.date.isoformat()
+        timestamp = entry.meta.get("timestamp")
+        txn_type = entry.meta.get("type")
+        for account, units in changes.items():
+            added.append((account, HistoryEntry(date, timestamp, txn_type, entry.narration, tuple(units.items()))))
+    return added
+
+
+class StaleCursor(Exception):
+    """The history has been rebuilt since the cursor was handed out"""
+    pass
+
+
+def history_page(state: "RepoState", account: str, cursor: typing.Optional[str], limit: int) \
+        -> typing.Tuple[typing.List[HistoryEntry], typing.Optional[str]]:
+    """A page of the history of account, newest first, along with the
+    cursor for the next page (or None if this is the last one). A cursor is
+    the position in the account's history where the page ends, which stays
+    valid for as long as the history isn't rebuilt."""
+    entries = state.history.get(account, [])
+    if cursor:
+        history_id, separator, position = cursor.rpartition(":")
+        if not separator:
+            raise ValueError("Invalid cursor", cursor)
+        if history_id != state.history_id:
+            raise StaleCursor()
+        end = int(position)
+        if not 0 <= end <= len(entries):
+            raise ValueError("Cursor out of range", cursor)
+    else:
+        end = len(entries)
+    start = max(0, end - limit)
+    page = entries[start:end]
+    page.reverse()
+    return page, ("%s:%d" % (state.history_id, start) if start > 0 else None)
+
+
+# What was sold on one day.
+# products: (units, cents) by product currency
+# paybacks: cents owed to each payback account
+DayStats = collections.namedtuple("DayStats", ["products", "paybacks"])
+
+
+def add_day_stats(day_stats: DayStats, other: DayStats) -> DayStats:
+    """The sum of two DayStats, as a new one"""
+    products = dict(day_stats.products)
+    for currency, (units, cents) in other.products.items():
+        old_units, old_cents = products.get(currency, (0, 0))
+        products[currency] = (old_units + units, old_cents + cents)
+    paybacks = dict(day_stats.paybacks)
+    for account, cents in other.paybacks.items():
+        paybacks[account] = paybacks.get(account, 0) + cents
+    return DayStats(products, paybacks)
+
+
+def purchase_stats(entries: typing.Iterable[bcdata.Directive],
+                   products: typing.Dict[str, "Product"]) -> typing.Dict[str, DayStats]:
+    """Sum up the purchases among entries by day. The ledger only has what
+    each purchase charged in total, so that gets split over its products by
+    their price in the catalog; for purchases at the current prices, that's
+    exactly what each of them cost."""
+    stats = {}
+    for entry in entries:
+        if not isinstance(entry, bcdata.Transaction) or entry.meta.get("type") != "purchase":
+            continue
+        units = {}
+        charge = 0
+        paybacks = {}
+        for posting in entry.postings:
+            currency = posting.units.currency
+            if currency != "EUR":
+                if posting.account == INVENTORY_ACCT:
+                    units[currency] = units.get(currency, 0) - _units(posting.units.number, currency)
+            elif is_bar_account(posting.account):
+                charge += _units(posting.units.number, currency)
+            elif posting.account != INCOME_ACCT:
+                paybacks[posting.account] = paybacks.get(posting.account, 0) - _units(posting.units.number, currency)
+        if not units:
+            continue
+
+        weights = {currency: count * products[currency].price if currency in products else 0
+                   for currency, count in units.items()}
+        total = sum(weights.values())
+        if total <= 0:
+            # None of them are in the catalog any more
+            weights = {currency: 1 for currency in units}
+            total = len(units)
+        day = stats.get(entry.date.isoformat())
+        if day is None:
+            day = stats[entry.date.isoformat()] = DayStats({}, {})
+        remaining = charge
+        for i, (currency, count) in enumerate(units.items()):
+            # The last one gets what rounding left over
+            share = remaining if i == len(units) - 1 else charge * weights[currency] // total
+            remaining -= share
+            old_units, old_cents = day.products.get(currency, (0, 0))
+            day.products[currency] = (old_units + count, old_cents + share)
+        for account, cents in paybacks.items():
+            day.paybacks[account] = day.paybacks.get(account, 0) + cents
+    return stats
+
+
+def add_to_stats(stats: typing.Dict[str, DayStats], added: typing.Dict[str, DayStats]):
+    """Add stats by day to stats, in place. Days that are already in there
+    get replaced with the sum rather than changed, so that a reader never
+    sees half an update."""
+    for day, day_stats in added.items():
+        old = stats.get(day)
+        stats[day] = day_stats if old is None else add_day_stats(old, day_stats)
+
+
+def sales_stats(state: "RepoState", first: datetime.date, last: datetime.date, weekly: bool = False) \
+        -> typing.Tuple[typing.List[typing.Tuple[datetime.date, DayStats]], DayStats]:
+    """The sales of each day (or week, starting on Monday) from first to
+    last, skipping the ones without any, along with the total. This only
+    looks at the days in between, however many others there are."""
+    periods = []
+    total = DayStats({}, {})
+    day = first
+    while day <= last:
+        day_stats = state.stats.get(day.isoformat())
+        if day_stats is not None:
+            start = day - datetime.timedelta(days=day.weekday()) if weekly else day
+            if periods and periods[-1][0] == start:
+                periods[-1] = (start, add_day_stats(periods[-1][1], day_stats))
+            else:
+                periods.append((start, day_stats))
+            total = add_day_stats(total, day_stats)
+        day += datetime.timedelta(days=1)
+    return periods, total
+
+
+class IdempotencyCache:
+    """Responses to recent transaction requests, by the idempotency key the
+    client sent along, so that a retry can get the same response instead of
+    applying the transactions again. Keys are forgotten after ttl seconds,
+    or earlier when there are more than max_keys of them.
+
+    Along with the response goes a hash of the request (see
+    server.request_hash), so that reusing a key for a different request
+    can be told apart from a retry; it's None where that isn't known."""
+    ttl: float
+    max_keys: int
+    # (time of the request, request hash, response) by key, oldest first
+    _responses: "collections.OrderedDict[str, typing.Tuple[float, typing.Optional[str], typing.Dict]]"
+
+    def __init__(self, ttl: float, max_keys: int):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._responses = collections.OrderedDict()
+
+    def get(self, key: str) -> typing.Optional[typing.Tuple[typing.Optional[str], typing.Dict]]:
+        """The request hash and the response for key, if it's known"""
+        self._expire()
+        entry = self._responses.get(key)
+        return entry[1:] if entry is not None else None
+
+    def put(self, key: str, response: typing.Dict, request_hash: typing.Optional[str] = None,
+            created: typing.Optional[float] = None):
+        """Remember response for key; created is when the request came in,
+        as a Unix time, if not just now"""
+        self._responses[key] = (created if created is not None else time.time(), request_hash, response)
+        self._responses.move_to_end(key)
+        self._expire()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._responses
+
+    def items(self) -> typing.List[typing.Tuple[str, float, typing.Optional[str], typing.Dict]]:
+        """The keys along with the time of the request, its hash and the
+        response, oldest first"""
+        self._expire()
+        return [(key,) + entry for key, entry in self._responses.items()]
+
+    def _expire(self):
+        since = time.time() - self.ttl
+        while self._responses:
+            key, (created, _, _) = next(iter(self._responses.items()))
+            if created > since and len(self._responses) <= self.max_keys:
+                break
+            del self._responses[key]
 
 
-def parse_price(price_str: typing.Union[float, str, decimal.Decimal, int]) -> decimal.Decimal:
-    return decimal.Decimal(price_str).quantize(decimal.Decimal('0.00'), decimal.ROUND_HALF_EVEN)
+def add_ledger_requests(cache: IdempotencyCache, entries: typing.Iterable[bcdata.Directive],
+                        accounts_raw: typing.Dict[str, "Member"]):
+    """Add the requests recorded in the ledger by their idempotency_key
+    (and request_hash) metadata to cache, unless it knows them already. The
+    ledger doesn't have the original responses, so these get one in the
+    same shape, with the balances as they are in accounts_raw."""
+    since = time.time() - cache.ttl
+    requests = collections.OrderedDict()
+    for entry in entries:
+        if not isinstance(entry, bcdata.Transaction):
+            continue
+        key = entry.meta.get("idempotency_key")
+        if key is None or key in cache or "timestamp" not in entry.meta:
+            continue
+        try:
+            created = datetime.datetime.fromisoformat(entry.meta["timestamp"]) \
+                .replace(tzinfo=datetime.timezone.utc).timestamp()
+        except (TypeError, ValueError):
+            continue
+        if created > since:
+            # The transactions of a batch all carry its key
+            requests.setdefault(key, (created, []))[1].append(entry)
+    for key, (created, txns) in requests.items():
+        members = {}
+        for txn in txns:
+            for posting in txn.postings:
+                if posting.account in accounts_raw:
+                    member = accounts_raw[posting.account]
+                    members[member.internal_name] = member.balance_json()
+        cache.put(key, {
+            "members": members,
+            "message": "\n".join(txn.narration for txn in txns),
+            "messages": [txn.narration for txn in txns],
+        }, request_hash=txns[0].meta.get("request_hash"), created=created)
 
 
 class UpdateFailed(Exception):
@@ -38,13 +460,36 @@ class UpdateFailed(Exception):
 
 
 class Member:
+    """A bar account and its balance. To keep rendering cheap, the balance
+    is kept in a compact form: EUR as integer cents, and the number of each
+    product as a fixed array indexed by product currency, together with the
+    total number of items. Anything else (e.g., products that have since
+    been removed) ends up in other_balance.
+
+    Members are never modified once they're part of a RepoState."""
+    __slots__ = (
+        "internal_name",
+        "display_name",
+        "account",
+        "item_currencies",
+        "balance_cents",
+        "item_counts",
+        "item_count",
+        "other_balance",
+    )
+
     internal_name: str
     display_name: str
     account: str
-    balance: bcinv.Inventory
-    item_currencies: typing.Set[str]
+    # Maps product currencies to their index in item_counts; shared by all
+    # members
+    item_currencies: typing.Dict[str, int]
+    balance_cents: int
+    item_counts: array.array
+    item_count: int
+    other_balance: typing.Optional[bcinv.Inventory]
 
-    def __init__(self, account, item_curencies):
+    def __init__(self, account, item_curencies: typing.Dict[str, int]):
         account_parts = account.split(":")
         if account == "Assets:Cash:Bar":
             self.display_name = "--CASH--"
@@ -54,26 +499,95 @@ class Member:
         else:
             self.display_name = self.internal_name = account_parts[-1]
         self.account = account
-        self.balance = decimal.Decimal("0.00")
         self.item_currencies = item_curencies
+        self.balance_cents = 0
+        self.item_counts = array.array("q", bytes(8 * len(item_curencies)))
+        self.item_count = 0
+        self.other_balance = None
+
+    def _copy(self) -> "Member":
+        member = Member.__new__(Member)
+        member.internal_name = self.internal_name
+        member.display_name = self.display_name
+        member.account = self.account
+        member.item_currencies = self.item_currencies
+        member.balance_cents = self.balance_cents
+        member.item_counts = array.array("q", self.item_counts)
+        member.item_count = self.item_count
+        member.other_balance = self.other_balance
+        return member
+
+    def load_inventory(self, inventory: bcinv.Inventory):
+        """Set the balance from a beancount inventory. Only to be used while
+        building a member."""
+        self.balance_cents = 0
+        self.item_counts = array.array("q", bytes(8 * len(self.item_currencies)))
+        self.other_balance = None
+        for position in inventory:
+            self._add_units(position.units.number, position.units.currency)
+        self.item_count = sum(self.item_counts)
+
+    def _add_units(self, number: decimal.Decimal, currency: str) -> int:
+        """Add to the balance in place; returns the change in item count"""
+        if currency == "EUR":
+            self.balance_cents += int((number * 100).to_integral_value(decimal.ROUND_HALF_EVEN))
+            return 0
+        index = self.item_currencies.get(currency)
+        if index is not None:
+            count = int(number.to_integral_value(decimal.ROUND_HALF_EVEN))
+            self.item_counts[index] += count
+            return count
+        other_balance = bcinv.Inventory(self.other_balance)
+        other_balance.add_amount(bcdata.Amount(number, currency))
+        self.other_balance = other_balance
+        return 0
+
+    def _add_leg(self, units: int, currency: str):
+        """Add a transaction leg to the balance in place"""
+        if currency == "EUR":
+            self.balance_cents += units
+            return
+        index = self.item_currencies.get(currency)
+        if index is not None:
+            self.item_counts[index] += units
+            self.item_count += units
+        else:
+            self._add_units(decimal.Decimal(units), currency)
+
+    def balance_json(self) -> typing.Dict:
+        return {
+            # The balance is negative in the ledger, because the
+            # accounts are seen from the hackerspace's viewpoint
+            "balance": str(-self.balance_eur),
+            "items": self.item_count,
+        }
+
+    def with_amount(self, amount: bcdata.Amount) -> "Member":
+        """Return a copy of this member with amount added to the balance"""
+        member = self._copy()
+        member.item_count += member._add_units(amount.number, amount.currency)
+        return member
 
     @property
-    def balance_eur(self):
-        return self.balance.get_currency_units("EUR").number.quantize(
-            decimal.Decimal("0.00"), decimal.ROUND_HALF_EVEN)
+    def balance(self) -> bcinv.Inventory:
+        """The balance as a beancount inventory. This is slow; it's only meant
+        for places where beancount needs it"""
+        inventory = bcinv.Inventory(self.other_balance)
+        if self.balance_cents:
+            inventory.add_amount(bcdata.Amount(decimal.Decimal(self.balance_cents).scaleb(-2), "EUR"))
+        for currency, index in self.item_currencies.items():
+            if self.item_counts[index]:
+                inventory.add_amount(bcdata.Amount(decimal.Decimal(self.item_counts[index]), currency))
+        return inventory
 
     @property
-    def item_count(self):
-        return sum(
-            int(self.balance.get_currency_units(currency).number.quantize(
-                decimal.Decimal("0"), decimal.ROUND_HALF_EVEN))
-            for currency in self.item_currencies
-        )
+    def balance_eur(self) -> decimal.Decimal:
+        return decimal.Decimal(self.balance_cents).scaleb(-2)
 
 
 Payback = collections.namedtuple("Payback", {
     "account": str,
-    "amount": decimal.Decimal,
+    "amount": Cents,
 })
 
 
@@ -86,7 +600,7 @@ class Product:
     # The name of a the currency that should be used for
     # inventory tracking. Should be short and all caps
     currency: str
-    price: decimal.Decimal
+    price: Cents
 
     payback: typing.Optional[Payback]
 
@@ -123,9 +637,15 @@ class Product:
         }
 
 
+# One posting of a transaction. units is in cents for EUR, and a count for
+# products
+Leg = collections.namedtuple("Leg", ["account", "units", "currency"])
+
+
 class Transaction:
-    txn: bcdata.Transaction
+    legs: typing.List[Leg]
     primary_account: typing.Optional[Member]
+    _txn: typing.Optional[bcdata.Transaction]
 
     def __init__(self,
                  title: str=None,
@@ -143,19 +663,41 @@ class Transaction:
         self.primary_account = None
         if title is None:
             raise TypeError("Title must be provided for a transaction")
-        self.txn = bcdata.Transaction(
-            meta, date,
-            flag="txn",
-            payee=None,
-            narration=title,
-            tags=set(),
-            links=set(),
-            postings=[],
-        )
+        self.title = title
+        self.date = date
+        self.meta = meta
+        self.legs = []
+        self._txn = None
+
+    def add_leg(self, account: str, units: int, currency: str):
+        self.legs.append(Leg(account, units, currency))
+
+    def is_balanced(self) -> bool:
+        totals = collections.Counter()
+        for leg in self.legs:
+            totals[leg.currency] += leg.units
+        return not any(totals.values())
 
     @property
-    def beancount_txn(self):
-        return self.txn
+    def beancount_txn(self) -> bcdata.Transaction:
+        if self._txn is None:
+            txn = bcdata.Transaction(
+                self.meta, self.date,
+                flag="txn",
+                payee=None,
+                narration=self.title,
+                tags=set(),
+                links=set(),
+                postings=[],
+            )
+            for leg in self.legs:
+                if leg.currency == "EUR":
+                    number = Cents(leg.units).to_decimal()
+                else:
+                    number = decimal.Decimal(leg.units)
+                bcdata.create_simple_posting(txn, leg.account, number, leg.currency)
+            self._txn = txn
+        return self._txn
 
 
 class BuyTxn(Transaction):
@@ -163,57 +705,42 @@ class BuyTxn(Transaction):
                  buyer: Member,
                  products: typing.List[typing.Tuple[Product, int]],
                  date: typing.Optional[datetime.datetime]=None):
-        total_cost = decimal.Decimal("0.00")
+        charge = Cents(0)
         total_count = 0
-        for product, count in products:
-            total_count += count
-            total_cost += count * product.price
+        paybacks = collections.defaultdict(int)
+        for product, qty in products:
+            if not isinstance(qty, int):
+                raise TypeError("Product quantities must be integers", qty)
+            total_count += qty
+            charge += product.price * qty
+            if product.payback is not None:
+                paybacks[product.payback.account] += product.payback.amount * qty
 
         super(BuyTxn, self).__init__(
             title="%s bought %d items for €%s" % (
-                buyer.display_name, total_count, total_cost,
+                buyer.display_name, total_count, charge,
             ),
             date=date,
             meta={
                 "type": "purchase",
             })
         self.primary_account = buyer
-        charge = decimal.Decimal("0.00")
-        paybacks = collections.defaultdict(lambda: decimal.Decimal("0.00"))
 
         for product, qty in products:
-            charge += product.price * qty
-            if product.payback is not None:
-                paybacks[product.payback.account] += \
-                    product.payback.amount * qty
-            bcdata.create_simple_posting(
-                self.txn, "Assets:Inventory:Bar",
-                -qty, product.currency)
-            bcdata.create_simple_posting(
-                self.txn, buyer.account,
-                qty, product.currency
-            )
-        bcdata.create_simple_posting(
-            self.txn, buyer.account,
-            charge, "EUR"
-        )
+            self.add_leg(INVENTORY_ACCT, -qty, product.currency)
+            self.add_leg(buyer.account, qty, product.currency)
+        self.add_leg(buyer.account, charge, "EUR")
         for payee, amt in paybacks.items():
-            bcdata.create_simple_posting(
-                self.txn, payee,
-                -amt, "EUR"
-            )
+            self.add_leg(payee, -amt, "EUR")
             charge -= amt
-        bcdata.create_simple_posting(
-            self.txn, "Income:Bar",
-            -charge, "EUR",
-        )
+        self.add_leg(INCOME_ACCT, -charge, "EUR")
 
 
 class TransferTxn(Transaction):
     def __init__(self,
                  payer: Member,
                  payee: Member,
-                 amount: decimal.Decimal,
+                 amount: Cents,
                  date: typing.Optional[datetime.datetime]=None):
         super(TransferTxn, self).__init__(
             title="%s gave %s a gift of €%s" % (
@@ -225,16 +752,14 @@ class TransferTxn(Transaction):
                  "type": "transfer",
             })
         self.primary_account = payer
-        bcdata.create_simple_posting(
-            self.txn, payer.account,  amount, "EUR")
-        bcdata.create_simple_posting(
-            self.txn, payee.account, -amount, "EUR")
+        self.add_leg(payer.account, amount, "EUR")
+        self.add_leg(payee.account, -amount, "EUR")
 
 
 class DepositTxn(Transaction):
     def __init__(self,
                  member: Member,
-                 amount: decimal.Decimal,
+                 amount: Cents,
                  date: typing.Optional[datetime.datetime]=None):
         super(DepositTxn, self).__init__(
             title="%s deposited €%s" % (member.display_name, amount),
@@ -244,103 +769,441 @@ class DepositTxn(Transaction):
             })
 
         self.primary_account = member
-        bcdata.create_simple_posting(
-            self.txn, member.account, -amount, "EUR")
-        bcdata.create_simple_posting(
-            self.txn, CASH_ACCT,  amount, "EUR")
+        self.add_leg(member.account, -amount, "EUR")
+        self.add_leg(CASH_ACCT, amount, "EUR")
+
+
+class LedgerWriter:
+    """Appends entries to a ledger file, which is kept open for as long as
+    the writer lives. Every call to write_entries results in a single write.
+
+    The fsync policy decides when written entries are forced to disk:
+    txn: before write_entries returns
+    batch: only when sync is called (i.e., when the batch is committed)
+    interval: on a write at least fsync_interval seconds after the last one
+    """
+    path: str
+    fsync_policy: str
+    fsync_interval: float
+    # The size of the file as far as we know, i.e., the offset at which the
+    # next entry will be written
+    offset: int
+    # How much of the file is known to be on disk
+    synced_offset: int
+    _file: typing.BinaryIO
+    _last_sync: float
+
+    FSYNC_POLICIES = ("txn", "batch", "interval")
+
+    def __init__(self, path: str, fsync_policy: str = "txn", fsync_interval: float = 1.0):
+        if fsync_policy not in self.FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy", fsync_policy)
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self._file = open(path, "ab")
+        self.offset = self.synced_offset = self._file.seek(0, os.SEEK_END)
+        self._last_sync = time.monotonic()
+
+    def write_entries(self, entries: typing.Iterable[bcdata.Directive]) -> typing.Tuple[int, int]:
+        """Append entries to the ledger; returns the start and end offsets
+        of the written text"""
+        import beancount.parser.printer
+
+        text = io.StringIO()
+        for entry in entries:
+            beancount.parser.printer.print_entry(entry, file=text)
+        start = self.offset
+        self._file.write(text.getvalue().encode("utf-8"))
+        self._file.flush()
+        self.offset = self._file.tell()
+        if (self.fsync_policy == "txn"
+                or (self.fsync_policy == "interval"
+                    and time.monotonic() - self._last_sync >= self.fsync_interval)):
+            self.sync()
+        return start, self.offset
+
+    def sync(self):
+        if self.synced_offset == self.offset:
+            return
+        os.fsync(self._file.fileno())
+        self.synced_offset = self.offset
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+def complete_length(text: bytes) -> typing.Optional[int]:
+    """How much of text, as appended to a ledger file by a run that may
+    have stopped in the middle of a write, holds complete entries. Returns
+    None if even that doesn't parse, as then it wasn't just the last write
+    that went wrong."""
+    # Entries start on an unindented line. The last one is only known to be
+    # complete if it's followed by the blank line LedgerWriter puts after
+    # every entry, or is a single line, like an include.
+    cut = 0
+    for match in re.finditer(rb"\n(?=[^ \t\n])", text):
+        cut = match.end()
+    if text.endswith(b"\n\n") or re.search(rb"(^|\n)[^ \t\n][^\n]*\n\Z", text):
+        cut = len(text)
+
+    try:
+        entries, errors, _ = beancount.parser.parser.parse_string(text[:cut].decode("utf-8"))
+    except UnicodeDecodeError:
+        return None
+    if errors:
+        return None
+    if cut < len(text):
+        # The transactions of a batch get written at once, and either all
+        # of them count or none; drop the rest of a torn one
+        torn_keys = set(re.findall(rb'idempotency_key: "([^"]*)"', text[cut:]))
+        while (entries and isinstance(entries[-1], bcdata.Transaction)
+               and entries[-1].meta.get("idempotency_key", "").encode("utf-8") in torn_keys):
+            # Cut at the start of the entry's first line
+            lineno = entries.pop().meta["lineno"]
+            cut = sum(len(line) + 1 for line in text.split(b"\n")[:lineno - 1])
+    return cut
+
+
+# The live state of the bar. Never modified in place; see the concurrency
+# model above.
+# version: incremented whenever the state changes, so that derived data
+#    (e.g., rendered responses) can be cached
+# accounts: members by internal name
+# accounts_raw: the same members by account
+# products: products by currency
+# item_currencies: the index of each product currency in Member.item_counts
+# raw_products: the product definitions as found in products.yml
+# bc_options_map: beancount options, as needed to check transactions
+# loaded_files: absolute paths of the ledger files the state was built
+#    from, or None if nothing has been loaded yet
+# ledger_accounts: the LedgerAccount of every account in the ledger, bar
+#    account or not
+# last_date: the date of the latest entry in the ledger, or None if it's
+#    empty. Anything dated before it gets sorted in between the entries
+#    already loaded
+# head: the commit the state was built from. Local commits of what the
+#    state already has move it along, so that the next pull only needs to
+#    look at what's new after it
+# history: the transactions of each bar account, oldest first, by account,
+#    or None while it's only in the history log (see load_history). Unlike
+#    everything else, these lists get appended to in place; readers of an
+#    older state may see a newer entry at the end, which is harmless
+# history_id: changes whenever the history gets rebuilt from scratch, as
+#    positions in it are only meaningful until then
+# stats: DayStats of the purchases by day, as an ISO date. Like history,
+#    this gets updated in place, but only by replacing or adding days
+RepoState = collections.namedtuple("RepoState", [
+    "version",
+    "accounts",
+    "accounts_raw",
+    "products",
+    "item_currencies",
+    "raw_products",
+    "bc_options_map",
+    "loaded_files",
+    "ledger_accounts",
+    "last_date",
+    "head",
+    "history",
+    "history_id",
+    "stats",
+])
 
 
 class RepoData:
-    accounts: typing.Dict[str, Member]
-    accounts_raw: typing.Dict[str, Member]
-    products: typing.Dict[str, Product]
+    state: RepoState
 
     # Invariants:
     # instance_ledger_name: the relative path from the data root to the active
     #    ledger file. Does not change once created
-    # instance_ledger: The actual ledger file. Closed and set to None whenever
-    #    the underlying file may have changed; opened when needed
+    # instance_ledger: The writer for the ledger file. Closed and set to None
+    #    whenever the underlying file may have changed; opened when needed
+    # committed_offset: the size of the instance ledger as of the last commit
     instance_ledger_name: typing.Optional[str]
     instance_ledger_uncommitted: bool
+    _instance_ledger_writer: typing.Optional["LedgerWriter"]
+    committed_offset: int
+
+    # How many entries of the current history are in the history log, and
+    # how long it is; None if the log can't be relied on
+    _history_logged: typing.Optional[typing.Tuple[int, int]]
+    # History entries that still need to go into the log
+    _history_unlogged: typing.List[typing.Tuple[str, HistoryEntry]]
 
     synchronized: bool
     _repo_path: str
+    _git: typing.Optional[git.SubprocessGit]
+
+    # Group commit state. Transactions are durable once they have been
+    # appended (and fsynced) to the instance ledger; the committer thread
+    # later bundles them into a single commit and push.
+    # pending_txns: transactions appended but not yet committed
+    # pending_since: time.monotonic() of the oldest pending transaction
+    # unpushed_commits: local commits that have not reached the remote yet
+    pending_txns: int
+    pending_since: typing.Optional[float]
+    unpushed_commits: int
+    last_push: typing.Optional[datetime.datetime]
+    last_push_error: typing.Optional[str]
+    _commit_cond: threading.Condition
+    _push_lock: threading.Lock
+    _committer: typing.Optional[threading.Thread]
+
+    # Background sync state. The sync loop has its own lock, as it mustn't
+    # hold the repo lock while fetching.
+    # syncing: whether the sync loop is pulling right now
+    # last_sync: when the last pull by the sync loop finished
+    # last_sync_error: why that pull failed, or None if it succeeded
+    syncing: bool
+    last_sync: typing.Optional[datetime.datetime]
+    last_sync_error: typing.Optional[str]
+    _sync_cond: threading.Condition
+    _sync_requested: bool
+    _syncer: typing.Optional[threading.Thread]
+
+    # Guarded by the repo lock
+    _idempotency_cache: typing.Optional[IdempotencyCache]
+
+    # Full reloads parse the ledger without holding the repo lock (see
+    # _merge_upstream). Meanwhile, the transactions applied collect in
+    # _reload_backlog, to go on top of what got parsed, and nothing gets
+    # committed. None while no full reload is going on.
+    # _pull_lock: held for the whole of a pull, so that pulls don't overlap
+    _reload_backlog: typing.Optional[typing.List[bcdata.Transaction]]
+    _pull_lock: threading.Lock
 
     def __init__(self, repo_path=None):
         self.instance_ledger_name = None
         self.instance_ledger_uncommitted = True
+        self._instance_ledger_writer = None
+        self.committed_offset = 0
+        self._history_logged = None
+        self._history_unlogged = []
+        self._idempotency_cache = None
+        self.state = RepoState(
+            version=0,
+            accounts={},
+            accounts_raw={},
+            products={},
+            item_currencies={},
+            raw_products=[],
+            bc_options_map=None,
+            loaded_files=None,
+            ledger_accounts={},
+            last_date=None,
+            head=None,
+            history={},
+            history_id=None,
+            stats={},
+        )
         self.synchronized = False
         self._repo_path = repo_path or None
+        self._git = None
+        self.pending_txns = 0
+        self.pending_since = None
+        self.unpushed_commits = 0
+        self.last_push = None
+        self.last_push_error = None
+        self._commit_cond = threading.Condition(repo_lock)
+        self._push_lock = threading.Lock()
+        self._committer = None
+        self.syncing = False
+        self.last_sync = None
+        self.last_sync_error = None
+        self._sync_cond = threading.Condition()
+        self._sync_requested = False
+        self._syncer = None
+        self._reload_backlog = None
+        self._pull_lock = threading.Lock()
 
     @property
     def repo_path(self):
         return self._repo_path or SERVER_CONFIG.DATA_DIR
 
-    @transaction()
+    # Shortcuts into the current state. When using more than one of these,
+    # fetch self.state once instead; the state may change in between.
+
+    @property
+    def version(self) -> int:
+        return self.state.version
+
+    @property
+    def accounts(self) -> typing.Dict[str, Member]:
+        return self.state.accounts
+
+    @property
+    def products(self) -> typing.Dict[str, Product]:
+        return self.state.products
+
+    @property
+    def loaded(self) -> bool:
+        """Whether there is any state to serve from yet"""
+        return self.state.loaded_files is not None
+
+    def _update_state(self, **changes):
+        """Publish a new state with the given fields replaced. Must be called
+        with the repo lock held"""
+        self.state = self.state._replace(version=self.state.version + 1, **changes)
+
     def pull_changes(self):
-        """Pull the latest changes from the upstream git repo"""
-        self.synchronized = False
-        try:
-            subprocess.run("git pull --no-edit "
-                           "|| ( git merge --abort; false; )",
-                           shell=True,
-                           cwd=self.repo_path,
-                           stderr=subprocess.PIPE,
-                           check=True)
-        except subprocess.CalledProcessError as e:
-            raise UpdateFailed(e.stderr)
+        """Pull the latest changes from the upstream git repo. The fetch
+        happens without holding the repo lock; only merging and reloading
+        the state do, and a full reload only holds it to swap in the new
+        state."""
+        with self._pull_lock:
+            start = time.perf_counter()
+            # How the state got reloaded, for the metrics
+            reload = "failed"
+            try:
+                try:
+                    self.git.fetch()
+                    behind = self.git.ahead_behind()[1]
+                except subprocess.SubprocessError as e:
+                    raise UpdateFailed(str(e))
+                if behind == 0 and self.loaded and self.state.head == self.git_head():
+                    reload = "none"
+                    self.synchronized = True
+                else:
+                    reload = self._merge_upstream()
+            finally:
+                metrics.PULL_SECONDS.observe(time.perf_counter() - start, reload=reload)
 
-        try:
-            self.load_data()
-        except Exception as e:
-            # Output error to assist in troubleshooting
-            print("Error while loading data: ")
-            traceback.print_exception(e)
-            # Rollback
-            self.git_cmd("git", "checkout", "@{-1}")
-            if isinstance(e, UpdateFailed):
-                raise
-            else:
-                raise UpdateFailed("Failed to reload data") from e
-        self.synchronized = True
+    def _merge_upstream(self) -> str:
+        with transaction():
+            self.synchronized = False
+            old_head = self.git_head()
+            try:
+                self.git.merge_upstream()
+            except git.GitError as e:
+                raise UpdateFailed(str(e))
 
-    def git_cmd(self, *args):
-        print("\x1b[1;31mGit command: \x1b[0m" + " ".join(args))
-        subprocess.run(list(args),
-                       cwd=self.repo_path,
-                       check=True)
+            old_version = self.version
+            try:
+                # If the state isn't the one for old_head (e.g., an earlier
+                # reload failed), the changes since are unknown
+                if self.state.head == old_head and self.reload_incremental(old_head, self.git_head()):
+                    reload = "incremental"
+                elif self.load_snapshot():
+                    reload = "full"
+                else:
+                    reload = "full"
+                    cutoff = self._instance_ledger_lines()
+                    self._reload_backlog = []
+            except Exception as e:
+                self._rollback_merge(old_head, e)
 
-    def add_file(self, filename: str):
-        self.git_cmd("git", "add", filename)
+        if reload == "full":
+            # Parsing takes seconds; transactions carry on meanwhile, and
+            # get applied on top once it's done
+            try:
+                parsed = self._parse_ledger(cutoff)
+            except Exception as e:
+                parsed = None
+                error = e
+            with transaction():
+                backlog, self._reload_backlog = self._reload_backlog, None
+                # Let the committer catch up
+                self._commit_cond.notify_all()
+                try:
+                    if parsed is None:
+                        raise error
+                    self._publish_ledger(*parsed, backlog=backlog)
+                except Exception as e:
+                    self._rollback_merge(old_head, e)
+                if backlog:
+                    # The loader's pickle cache may have taken the sizes of
+                    # the files after those got appended to, but not what
+                    # was appended; make sure the next load doesn't use it
+                    for filename in (self.instance_ledger_name,
+                                     os.path.join(self.repo_path, "ledger", "dynamic.beancount")):
+                        os.utime(filename)
 
-    @contextlib.contextmanager
-    def git_transaction(self):
-        head = subprocess.check_output(["git", "rev-parse", "HEAD"],
-                                       cwd=self.repo_path)
-        head = head.decode("utf-8").strip()
-        try:
-            yield
-            self.git_cmd("git", "commit", "-m", "Automatic commit by backtab")
-        except Exception:
-            self.git_cmd("git", "reset", "--hard", head)
-            raise
+        with transaction():
+            self.synchronized = True
+            if self.version != old_version:
+                # Balances may have changed arbitrarily; clients should refetch
+                BROKER.publish("reload", {})
+        return reload
 
-        self.synchronized = False
+    def _rollback_merge(self, old_head: str, e: Exception):
+        """Undo the merge after reloading failed, and raise UpdateFailed.
+        Must be called with the repo lock held"""
+        # Output error to assist in troubleshooting
+        print("Error while loading data: ")
+        traceback.print_exception(e)
+        # Rollback; that leaves transactions that were appended but not
+        # committed yet alone
         try:
-            self.git_cmd("git", "push")
+            self.git.reset_merge(old_head)
         except subprocess.SubprocessError:
-            # Try pulling first
-            self.pull_changes()
-            self.git_cmd("git", "push")
-        self.synchronized = True
+            print("Failed to roll back the merge: ")
+            traceback.print_exc()
+        if isinstance(e, UpdateFailed):
+            raise e
+        raise UpdateFailed("Failed to reload data") from e
+
+    def _instance_ledger_lines(self) -> int:
+        """How many lines the instance ledger has, if there is one"""
+        if self.instance_ledger_name is None:
+            return 0
+        with open(self.instance_ledger_name, "rb") as f:
+            return f.read().count(b"\n")
+
+    @property
+    def git(self) -> git.SubprocessGit:
+        if self._git is None or self._git.repo_path != self.repo_path:
+            self._git = git.open_repo(self.repo_path, SERVER_CONFIG.GIT_BACKEND)
+            print("Using %s git backend" % (self._git.name,))
+            self._configure_merges()
+        return self._git
 
     @property
-    def instance_ledger(self) -> typing.TextIO:
+    def idempotency_cache(self) -> IdempotencyCache:
+        if self._idempotency_cache is None:
+            self._idempotency_cache = IdempotencyCache(SERVER_CONFIG.IDEMPOTENCY_TTL,
+                                                       SERVER_CONFIG.IDEMPOTENCY_MAX_KEYS)
+        return self._idempotency_cache
+
+    def _configure_merges(self):
+        """Set up union merges for UNION_MERGE_FILES in the clone's own
+        attributes, so that the data repo doesn't need to carry them"""
+        path = os.path.join(self.repo_path, ".git", "info", "attributes")
+        try:
+            with open(path, "rt") as f:
+                existing = f.read().splitlines()
+        except FileNotFoundError:
+            existing = []
+        missing = ["/%s merge=union" % (filename,) for filename in UNION_MERGE_FILES]
+        missing = [line for line in missing if line not in existing]
+        if missing:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "at") as f:
+                f.write("".join(line + "\n" for line in missing))
+
+    def git_head(self) -> str:
+        return self.git.head()
+
+    def git_output(self, *args) -> bytes:
+        assert args[0] == "git"
+        return self.git.output(*args[1:])
+
+    def git_cmd(self, *args):
+        assert args[0] == "git"
+        self.git.run(*args[1:])
+
+    def add_file(self, filename: str):
+        self.git.add(filename)
+
+    @property
+    def instance_ledger(self) -> "LedgerWriter":
         while self.instance_ledger_name is None:
             import datetime
             import socket
-            trial_name = "%(hostname)s_%(date)s.beancount" % {
-                "hostname": socket.gethostname(),
+            trial_name = "%(instance)s_%(date)s.beancount" % {
+                "instance": SERVER_CONFIG.INSTANCE_NAME or socket.gethostname(),
                 "date": datetime.datetime.now(datetime.timezone.utc),
             }
             try:
@@ -353,69 +1216,250 @@ class RepoData:
                 import time
                 time.sleep(1)
                 continue
-        while self.instance_ledger_uncommitted:
+        if self.instance_ledger_uncommitted:
+            # Include the instance ledger in the ledger. That only gets
+            # committed locally; the committer pushes it along with the
+            # first batch of transactions, so that nothing here waits for
+            # the remote.
+            dynamic_filename = os.path.join(self.repo_path, "ledger", "dynamic.beancount")
+            include_line = 'include "%s"\n' % os.path.basename(self.instance_ledger_name)
+            found_include = False
+            with open(dynamic_filename, "rt") as dynamic:
+                for line in dynamic:
+                    if line == include_line:
+                        found_include = True
+            if not found_include:
+                with open(dynamic_filename, "at") as dynamic:
+                    dynamic.write(include_line)
+        if self.instance_ledger_uncommitted and self._reload_backlog is None:
+            # During a full reload, this is left to commit_pending
+            self.add_file(self.instance_ledger_name)
+            self.add_file(os.path.join("ledger", "dynamic.beancount"))
             try:
-                # We have an instance ledger; add it to git and push
-                with self.git_transaction():
-                    dynamic_filename = os.path.join(self.repo_path, "ledger", "dynamic.beancount")
-                    include_line = 'include "%s"\n' % os.path.basename(self.instance_ledger_name)
-                    found_include = False
-                    with open(dynamic_filename, "rt") as dynamic:
-                        for line in dynamic:
-                            if line == include_line:
-                                found_include = True
-                    if not found_include:
-                        with open(dynamic_filename, "at") as dynamic:
-                            dynamic.write(include_line)
-                    with open(self.instance_ledger_name, "at"):
-                        # Make sure the file exists; it might have gotten destroyed by a failed push
-                        pass
-                    self.add_file(self.instance_ledger_name)
-                    self.add_file(os.path.join("ledger", "dynamic.beancount"))
-                self.instance_ledger_uncommitted = False
-                break
-            except subprocess.SubprocessError:
-                self.pull_changes()
-                continue
+                self._commit("Automatic commit by backtab (new instance ledger)")
+                self.unpushed_commits += 1
+            except git.NothingToCommit:
+                # An earlier attempt got as far as committing
+                pass
+            self.instance_ledger_uncommitted = False
 
-        return open(self.instance_ledger_name, "at")
+        if self._instance_ledger_writer is None:
+            self._instance_ledger_writer = LedgerWriter(
+                self.instance_ledger_name,
+                fsync_policy=SERVER_CONFIG.LEDGER_FSYNC,
+                fsync_interval=SERVER_CONFIG.LEDGER_FSYNC_INTERVAL,
+            )
+        return self._instance_ledger_writer
 
     @transaction()
     def apply_txn(self, txn: Transaction) -> typing.List[Member]:
-        bc_txn = txn.beancount_txn
+        return self.apply_txns([txn])
 
-        # Ensure that the transaction balances
-        residual = bcinterp.compute_residual(bc_txn.postings)
-        tolerances = bcinterp.infer_tolerances(bc_txn.postings, self.bc_options_map)
-        assert residual.is_small(tolerances), "Imbalanced transaction generated"
+    @transaction()
+    def apply_txns(self, txns: typing.List[Transaction]) -> typing.List[Member]:
+        """Apply a list of transactions all at once; either all of them end
+        up in the ledger (and in the same commit), or none of them do.
+        Returns the members that were changed, with their final balances."""
+        # Ensure that the transactions balance
+        for txn in txns:
+            assert txn.is_balanced(), "Imbalanced transaction generated"
+        bc_txns = [txn.beancount_txn for txn in txns]
 
-        # add the transaction to the ledger
-        while True:
-            try:
-                with self.git_transaction():
-                    beancount.parser.printer.print_entry(bc_txn, file=self.instance_ledger)
-                    self.instance_ledger.flush()
-                    self.add_file(self.instance_ledger_name)
-            except subprocess.SubprocessError:
-                self.pull_changes()
-            else:
-                break
+        # add the transactions to the ledger; they get committed and pushed
+        # by the committer thread
+        self.instance_ledger.write_entries(bc_txns)
+        if self._reload_backlog is not None:
+            self._reload_backlog.extend(bc_txns)
+        if self.pending_txns == 0:
+            self.pending_since = time.monotonic()
+        self.pending_txns += len(bc_txns)
+        self._commit_cond.notify_all()
 
+        # Once it's durable, apply it to the live state. Each changed member
+        # is copied once; the copies aren't visible to anyone until the new
+        # state is published, so they can be updated in place.
         changed_members = {}
-        # Once it's durable, apply it to the live state
-        for posting in bc_txn.postings:
-            if posting.account in self.accounts_raw:
-                member = self.accounts_raw[posting.account]
-                member.balance.add_amount(posting.units)
-                changed_members[member.internal_name] = member
+        accounts_raw = dict(self.state.accounts_raw)
+        for txn in txns:
+            for leg in txn.legs:
+                member = changed_members.get(leg.account)
+                if member is None:
+                    if leg.account not in accounts_raw:
+                        continue
+                    member = changed_members[leg.account] = accounts_raw[leg.account]._copy()
+                member._add_leg(leg.units, leg.currency)
+        accounts = dict(self.state.accounts)
+        for member in changed_members.values():
+            accounts_raw[member.account] = member
+            accounts[member.internal_name] = member
+        self._add_history(self.state.history, history_entries(bc_txns, accounts_raw))
+        add_to_stats(self.state.stats, purchase_stats(bc_txns, self.state.products))
+        last_date = self.state.last_date
+        for txn in bc_txns:
+            if last_date is None or txn.date > last_date:
+                last_date = txn.date
+        self._update_state(accounts=accounts, accounts_raw=accounts_raw, last_date=last_date)
         return list(changed_members.values())
 
+    def _appended_text(self, old_head: str, new_head: str, filename: str) -> typing.Optional[str]:
+        """Return the text appended to filename between the two commits, or
+        None if the file was changed in any other way. Include lines count
+        as appended wherever they got inserted; when two instances start at
+        the same time, the union merge of dynamic.beancount puts one of
+        their includes in between."""
+        old_text = self.git_output("git", "cat-file", "blob", "%s:%s" % (old_head, filename))
+        new_text = self.git_output("git", "cat-file", "blob", "%s:%s" % (new_head, filename))
+        if new_text.startswith(old_text) and (not old_text or old_text.endswith(b"\n")):
+            return new_text[len(old_text):].decode("utf-8")
+
+        old_lines = old_text.decode("utf-8").splitlines()
+        inserted = []
+        matched = 0
+        for line in new_text.decode("utf-8").splitlines():
+            if matched < len(old_lines) and line == old_lines[matched]:
+                matched += 1
+            elif INCLUDE_RE.match(line):
+                inserted.append(line + "\n")
+            else:
+                return None
+        if matched < len(old_lines):
+            return None
+        return "".join(inserted)
+
     @transaction()
-    def load_data(self):
+    def reload_incremental(self, old_head: str, new_head: str) -> bool:
+        """Apply the changes between two commits to the live state without
+        reloading the whole ledger. This only handles the common case of
+        ledger files being appended to (and new files being included from
+        them); it returns False if a full reload is needed instead."""
+        state = self.state
+        if state.loaded_files is None:
+            return False
+        if old_head == new_head:
+            return True
+
+        changes = self.git_output("git", "diff", "--no-renames", "--name-status", "-z",
+                                  old_head, new_head).decode("utf-8").split("\0")
+        # Sources to parse, as (absolute filename, text)
+        sources = []
+        for status, filename in zip(changes[0::2], changes[1::2]):
+            abs_filename = os.path.normpath(os.path.join(self.repo_path, filename))
+            if filename.startswith("static/"):
+                return False
+            if abs_filename not in state.loaded_files:
+                # Not part of the ledger (yet); if a changed file starts
+                # including it, it's picked up below
+                continue
+            if status != "M":
+                return False
+            appended = self._appended_text(old_head, new_head, filename)
+            if appended is None:
+                return False
+            sources.append((abs_filename, appended))
+
+        loaded_files = set(state.loaded_files)
+        new_entries = []
+        while sources:
+            filename, text = sources.pop(0)
+            entries, errors, options = beancount.parser.parser.parse_string(text, filename)
+            # Options would apply to the whole ledger, not just what's after
+            # them; parsing the appended text alone just ignores them
+            if errors or options["plugin"] or re.search(r"^option\b", text, re.MULTILINE):
+                return False
+            new_entries.extend(entries)
+            loaded_files.add(filename)
+            for include in options["include"]:
+                matches = glob.glob(os.path.join(os.path.dirname(filename), include))
+                if not matches:
+                    return False
+                for match in matches:
+                    match = os.path.normpath(match)
+                    if match in loaded_files:
+                        return False
+                    with open(match, "rt") as f:
+                        sources.append((match, f.read()))
+
+        # A full load sorts what's dated before the end of the ledger in
+        # between the entries we have, which would change the history
+        new_entries.sort(key=bcdata.entry_sortkey)
+        if new_entries and state.last_date is not None and new_entries[0].date < state.last_date:
+            return False
+
+        # Check everything before touching the live state, so that we never
+        # end up with half of the changes applied. Anything a full load
+        # would reject (or that needs the whole ledger to check) gets left
+        # to a full load
+        product_currencies = state.item_currencies
+        accts = dict(state.ledger_accounts)
+        new_members = {}
+        postings = []
+        for entry in new_entries:
+            if isinstance(entry, bcdata.Open):
+                if entry.account in accts:
+                    return False
+                accts[entry.account] = LedgerAccount(
+                    entry.date, None, tuple(entry.currencies) if entry.currencies else None)
+                if is_bar_account(entry.account):
+                    acct = Member(entry.account, item_curencies=product_currencies)
+                    if "display_name" in entry.meta:
+                        acct.display_name = entry.meta["display_name"]
+                    new_members[acct.account] = acct
+            elif isinstance(entry, bcdata.Transaction):
+                for posting in entry.postings:
+                    if (beancount.parser.parser.is_posting_incomplete(posting)
+                            or posting.cost is not None):
+                        return False
+                    if not can_post(accts.get(posting.account), entry.date, posting.units.currency):
+                        return False
+                residual = bcinterp.compute_residual(entry.postings)
+                tolerances = bcinterp.infer_tolerances(entry.postings, state.bc_options_map)
+                if not residual.is_small(tolerances):
+                    return False
+                postings.extend(entry.postings)
+            elif isinstance(entry, bcdata.Note):
+                # Notes are fine after the account got closed
+                account = accts.get(entry.account)
+                if account is None or entry.date < account.open:
+                    return False
+            elif not isinstance(entry, (bcdata.Price, bcdata.Event)):
+                # Balance assertions, Close, Pad and the like
+                return False
+
+        print("Incremental reload: %d new entries" % (len(new_entries),))
+        accounts_raw = dict(state.accounts_raw)
+        accounts_raw.update(new_members)
+        for posting in postings:
+            if posting.account in accounts_raw:
+                accounts_raw[posting.account] = accounts_raw[posting.account].with_amount(posting.units)
+        accounts = {member.internal_name: member for member in accounts_raw.values()}
+        history = state.history
+        if history is not None:
+            history = dict(history)
+            for account in new_members:
+                history[account] = []
+        self._add_history(history, history_entries(new_entries, accounts_raw))
+        add_to_stats(state.stats, purchase_stats(new_entries, state.products))
+        add_ledger_requests(self.idempotency_cache, new_entries, accounts_raw)
+        self._update_state(
+            accounts=accounts,
+            accounts_raw=accounts_raw,
+            loaded_files=frozenset(loaded_files),
+            ledger_accounts=accts,
+            last_date=new_entries[-1].date if new_entries else state.last_date,
+            head=new_head,
+            history=history,
+        )
+        self.save_snapshot()
+        return True
+
+    def load_products(self) -> typing.Tuple[typing.List[typing.Dict], typing.Dict[str, Product]]:
+        """Load the product catalog; returns the raw definitions along with
+        the products keyed by currency"""
         import yaml
 
         products = {}
-        with open(os.path.join(self.repo_path, "static", "products.yml"), "rt") as f:
+        with open(os.path.join(self.repo_path, "static", "products.yml"), "rt") as f, \
+                metrics.LOAD_PHASE_SECONDS.time(phase="products"):
             raw_products = yaml.load(f, Loader=yaml.SafeLoader)
         if type(raw_products) != list:
             raise TypeError("Products should be a list")
@@ -424,53 +1468,628 @@ class RepoData:
             if product.currency in products:
                 raise UpdateFailed("Duplicate product %s" % (product.name,))
             products[product.currency] = product
+        return raw_products, products
 
-        product_currencies = {product.currency for product in products.values()}
+    @transaction()
+    def load_data(self):
+        with metrics.LOAD_PHASE_SECONDS.time(phase="snapshot_load"):
+            if self.load_snapshot():
+                return
+        self._publish_ledger(*self._parse_ledger(self._instance_ledger_lines()))
+
+    def _parse_ledger(self, cutoff: int) \
+            -> typing.Tuple[typing.Dict, typing.List[bcdata.Directive], typing.List[typing.Tuple[str, HistoryEntry]]]:
+        """Load the ledger from scratch, without touching the live state, so
+        that this doesn't need the repo lock. Entries in the instance ledger
+        after its first cutoff lines get left out; they are the ones that
+        got applied meanwhile. Returns the fields of the new state, the
+        entries and the history entries."""
+        # The loader pulls in most of beancount; only import it when the
+        # snapshot can't be used
+        import beancount.loader
+        import beancount.parser.printer
+
+        # Anything committed after this gets picked up by the next pull
+        head = self.git_head()
+        raw_products, products = self.load_products()
+        product_currencies = {currency: index for index, currency in enumerate(products)}
 
         # Load ledger
-        ledger_data, errors, options = beancount.loader.load_file(
-            os.path.join(self.repo_path, "bartab.beancount")
-        )
+        with metrics.LOAD_PHASE_SECONDS.time(phase="ledger"):
+            ledger_data, errors, options = beancount.loader.load_file(
+                os.path.join(self.repo_path, "bartab.beancount")
+            )
+        instance_ledger_name = self.instance_ledger_name
+
+        def applied_meanwhile(meta: typing.Optional[typing.Dict]) -> bool:
+            return (meta is not None and meta.get("filename") == instance_ledger_name
+                    and meta.get("lineno", 0) > cutoff)
+
+        ledger_data = [entry for entry in ledger_data if not applied_meanwhile(entry.meta)]
+        # Including a write that was still going on
+        errors = [error for error in errors if not applied_meanwhile(error.source)]
         if errors:
             error_stream = io.StringIO("Failed to load ledger\n")
             beancount.parser.printer.print_errors(errors, error_stream)
             raise UpdateFailed(error_stream.getvalue())
 
+        with metrics.LOAD_PHASE_SECONDS.time(phase="balances"):
+            accounts, accounts_raw = build_members(ledger_data, product_currencies)
+            accts = ledger_accounts(ledger_data)
+
+        with metrics.LOAD_PHASE_SECONDS.time(phase="history"):
+            history = {account: [] for account in accounts_raw}
+            added = history_entries(ledger_data, accounts_raw)
+            for account, entry in added:
+                history[account].append(entry)
+
+        with metrics.LOAD_PHASE_SECONDS.time(phase="stats"):
+            stats = purchase_stats(ledger_data, products)
+
+        changes = dict(
+            accounts=accounts,
+            accounts_raw=accounts_raw,
+            products=products,
+            item_currencies=product_currencies,
+            raw_products=raw_products,
+            bc_options_map=options,
+            loaded_files=frozenset(options["include"]),
+            ledger_accounts=accts,
+            last_date=ledger_data[-1].date if ledger_data else None,
+            head=head,
+            history=history,
+            history_id=os.urandom(8).hex(),
+            stats=stats,
+        )
+        return changes, ledger_data, added
+
+    @transaction()
+    def _publish_ledger(self, changes: typing.Dict, ledger_data: typing.List[bcdata.Directive],
+                        added: typing.List[typing.Tuple[str, HistoryEntry]],
+                        backlog: typing.Sequence[bcdata.Transaction] = ()):
+        """Publish what _parse_ledger loaded, with the transactions in
+        backlog applied on top"""
+        if backlog:
+            accounts_raw = changes["accounts_raw"]
+            for txn in backlog:
+                for posting in txn.postings:
+                    if posting.account in accounts_raw:
+                        accounts_raw[posting.account] = accounts_raw[posting.account].with_amount(posting.units)
+            changes["accounts"] = {member.internal_name: member for member in accounts_raw.values()}
+            backlog_history = history_entries(backlog, accounts_raw)
+            for account, entry in backlog_history:
+                changes["history"][account].append(entry)
+            added = added + backlog_history
+            add_to_stats(changes["stats"], purchase_stats(backlog, changes["products"]))
+            last_date = max(txn.date for txn in backlog)
+            if changes["last_date"] is None or last_date > changes["last_date"]:
+                changes["last_date"] = last_date
+
+        # The log gets written along with the snapshot
+        self._history_logged = (0, 0)
+        self._history_unlogged = added
+        self._update_state(**changes)
+        # Requests from before a reload are in there already, with their
+        # actual responses
+        add_ledger_requests(self.idempotency_cache, ledger_data, changes["accounts_raw"])
+        self.save_snapshot()
+
+    # The history log holds the entries of the current history, pickled
+    # in batches after the history_id. Reading it back takes a lot longer
+    # than loading the rest of a snapshot, so that only happens once someone
+    # asks for a history (see load_history). Snapshots refer to the log by
+    # how many entries and bytes of it they cover, and new entries only get
+    # written out along with a snapshot.
+
+    @property
+    def history_log_path(self) -> str:
+        return os.path.join(self.repo_path, ".git", "backtab-history.log")
+
+    def _add_history(self, history: typing.Optional[typing.Dict[str, typing.List[HistoryEntry]]],
+                     added: typing.List[typing.Tuple[str, HistoryEntry]]):
+        """Append entries to history, if it's loaded, and queue them for the
+        history log"""
+        if history is not None:
+            for account, entry in added:
+                history[account].append(entry)
+        if self._history_logged is not None:
+            self._history_unlogged.extend(added)
+
+    def _write_history_log(self):
+        """Write out the queued history entries, starting a new log if
+        nothing has been logged yet. Must be called with the repo lock held"""
+        if self._history_logged is None:
+            return
+        count, size = self._history_logged
+        # In case writing fails halfway
+        self._history_logged = None
+        try:
+            with open(self.history_log_path, "ab" if size else "wb") as f:
+                if not size:
+                    pickle.dump(self.state.history_id, f, protocol=pickle.HIGHEST_PROTOCOL)
+                if self._history_unlogged:
+                    pickle.dump([(account, tuple(entry)) for account, entry in self._history_unlogged],
+                                f, protocol=pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+        except OSError:
+            print("Failed to write the history log: ")
+            traceback.print_exc()
+            return
+        self._history_logged = (count + len(self._history_unlogged), size)
+        self._history_unlogged = []
+
+    def _open_history_log(self, history_id: str, size: int) -> bool:
+        """Check that the history log is the one for history_id and at least
+        size bytes long, and cut off anything after that"""
+        try:
+            with open(self.history_log_path, "r+b") as f:
+                if pickle.load(f) != history_id or os.fstat(f.fileno()).st_size < size:
+                    return False
+                f.truncate(size)
+        except (OSError, pickle.PickleError, EOFError, ValueError):
+            return False
+        return True
+
+    @transaction()
+    def load_history(self) -> RepoState:
+        """Read the history from the history log if it isn't loaded yet.
+        Returns the state with the history, unless reading it failed."""
+        state = self.state
+        if state.history is not None:
+            return state
+        self._write_history_log()
+        if self._history_logged is None:
+            return state
+        count, _ = self._history_logged
+        history = {account: [] for account in state.accounts_raw}
+        start = time.perf_counter()
+        try:
+            with open(self.history_log_path, "rb") as f:
+                if pickle.load(f) != state.history_id:
+                    raise ValueError("The history log is for another history")
+                read = 0
+                while read < count:
+                    batch = pickle.load(f)
+                    for account, entry in batch:
+                        history.setdefault(account, []).append(HistoryEntry._make(entry))
+                    read += len(batch)
+        except (OSError, pickle.PickleError, EOFError, ValueError):
+            print("Failed to read the history log: ")
+            traceback.print_exc()
+            # Snapshots won't refer to it any more, so the next start rebuilds it
+            self._history_logged = None
+            return state
+        print("Loaded %d history entries in %.3fs" % (count, time.perf_counter() - start))
+        # The accounts are the same as before, so this isn't a new version
+        self.state = state._replace(history=history)
+        return self.state
+
+    # Snapshots of the loaded state, so that a restart doesn't need to
+    # parse the whole ledger. A snapshot is only valid for the exact
+    # HEAD it was taken at, plus the contents of any files that differed
+    # from HEAD at the time (e.g., transactions not committed yet), and
+    # for the SNAPSHOT_VERSION it was written with
+
+    @property
+    def snapshot_path(self) -> str:
+        return os.path.join(self.repo_path, ".git", "backtab-snapshot.json")
+
+    def _snapshot_key(self) -> typing.Dict:
+        import hashlib
+
+        dirty = {}
+        # Every untracked file, rather than the directories they're in
+        status = self.git_output("git", "status", "--porcelain", "-z",
+                                 "--untracked-files=all").decode("utf-8")
+        for line in status.split("\0"):
+            if not line:
+                continue
+            filename = line[3:]
+            try:
+                with open(os.path.join(self.repo_path, filename), "rb") as f:
+                    dirty[filename] = hashlib.sha1(f.read()).hexdigest()
+            except (FileNotFoundError, IsADirectoryError):
+                dirty[filename] = None
+        return {
+            "version": SNAPSHOT_VERSION,
+            "head": self.git_head(),
+            "dirty": dirty,
+        }
+
+    @transaction()
+    @metrics.LOAD_PHASE_SECONDS.time(phase="snapshot_save")
+    def save_snapshot(self):
+        if self._reload_backlog is not None:
+            # The state is still the one from before the merge
+            return
+        self._write_history_log()
+        state = self.state
+        try:
+            snapshot = {
+                "key": self._snapshot_key(),
+                "products": state.raw_products,
+                "accounts": [
+                    {
+                        "account": member.account,
+                        "display_name": member.display_name,
+                        "balance": [[str(position.units.number), position.units.currency]
+                                    for position in member.balance],
+                    }
+                    for member in state.accounts_raw.values()
+                ],
+                "options": {
+                    "inferred_tolerance_default": {
+                        currency: str(tolerance)
+                        for currency, tolerance in state.bc_options_map["inferred_tolerance_default"].items()
+                    },
+                    "inferred_tolerance_multiplier": str(state.bc_options_map["inferred_tolerance_multiplier"]),
+                    "infer_tolerance_from_cost": state.bc_options_map["infer_tolerance_from_cost"],
+                },
+                "loaded_files": sorted(os.path.relpath(filename, self.repo_path)
+                                       for filename in state.loaded_files),
+                "ledger_accounts": {
+                    account: [acct.open.isoformat(), acct.close and acct.close.isoformat(), acct.currencies]
+                    for account, acct in state.ledger_accounts.items()
+                },
+                "last_date": state.last_date and state.last_date.isoformat(),
+                "history": (
+                    {"id": state.history_id, "entries": self._history_logged[0], "size": self._history_logged[1]}
+                    if self._history_logged is not None else None),
+                "stats": {day: [day_stats.products, day_stats.paybacks] for day, day_stats in state.stats.items()},
+                "idempotency_requests": self.idempotency_cache.items(),
+            }
+            path = self.snapshot_path
+            with open(path + ".tmp", "wt") as f:
+                json.dump(snapshot, f)
+            os.replace(path + ".tmp", path)
+        except Exception:
+            # The snapshot is only an optimization
+            print("Failed to save snapshot: ")
+            traceback.print_exc()
+
+    @transaction()
+    def load_snapshot(self) -> bool:
+        """Restore the state from the snapshot if it matches the repo;
+        returns whether it did"""
+        import beancount.parser.options
+
+        try:
+            with open(self.snapshot_path, "rt") as f:
+                snapshot = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        if snapshot.get("key") != self._snapshot_key():
+            return False
+        history_log = snapshot.get("history")
+        if history_log is None or not self._open_history_log(history_log["id"], history_log["size"]):
+            print("History log doesn't match the snapshot")
+            return False
+        if any(field not in snapshot for field in ("stats", "idempotency_requests", "ledger_accounts")):
+            return False
+
+        products = {}
+        for raw_product in snapshot["products"]:
+            product = Product(raw_product)
+            products[product.currency] = product
+        product_currencies = {currency: index for index, currency in enumerate(products)}
+
         accounts = {}
         accounts_raw = {}
-        # TODO: Handle this using a realization
-        balances = {
-            row.account: row.balance
-            for row in beancount.query.query.run_query(ledger_data, options, """
-                select account, sum(position) as balance
-                where PARENT(account) = "Liabilities:Bar:Members"
-                   OR account = "Assets:Cash:Bar" 
-                group by account
-                """)[1]
+        for raw_member in snapshot["accounts"]:
+            acct = Member(raw_member["account"], item_curencies=product_currencies)
+            acct.display_name = raw_member["display_name"]
+            balance = bcinv.Inventory()
+            for number, currency in raw_member["balance"]:
+                balance.add_amount(bcdata.Amount(decimal.Decimal(number), currency))
+            acct.load_inventory(balance)
+            accounts[acct.internal_name] = acct
+            accounts_raw[acct.account] = acct
+
+        options = beancount.parser.options.OPTIONS_DEFAULTS.copy()
+        raw_options = snapshot["options"]
+        options["inferred_tolerance_default"] = {
+            currency: decimal.Decimal(tolerance)
+            for currency, tolerance in raw_options["inferred_tolerance_default"].items()
         }
-        for entry in ledger_data:
-            if not isinstance(entry, bcdata.Open):
+        options["inferred_tolerance_multiplier"] = decimal.Decimal(raw_options["inferred_tolerance_multiplier"])
+        options["infer_tolerance_from_cost"] = raw_options["infer_tolerance_from_cost"]
+
+        print("Loaded state from snapshot at %s" % (snapshot["key"]["head"],))
+        self._update_state(
+            accounts=accounts,
+            accounts_raw=accounts_raw,
+            products=products,
+            item_currencies=product_currencies,
+            raw_products=snapshot["products"],
+            bc_options_map=options,
+            loaded_files=frozenset(os.path.normpath(os.path.join(self.repo_path, filename))
+                                   for filename in snapshot["loaded_files"]),
+            ledger_accounts={
+                account: LedgerAccount(
+                    datetime.date.fromisoformat(open_date),
+                    close_date and datetime.date.fromisoformat(close_date),
+                    currencies and tuple(currencies))
+                for account, (open_date, close_date, currencies) in snapshot["ledger_accounts"].items()
+            },
+            last_date=snapshot["last_date"] and datetime.date.fromisoformat(snapshot["last_date"]),
+            head=snapshot["key"]["head"],
+            history=None,
+            history_id=history_log["id"],
+            stats={
+                day: DayStats({currency: tuple(sold) for currency, sold in sales.items()}, paybacks)
+                for day, (sales, paybacks) in snapshot["stats"].items()
+            },
+        )
+        self._history_logged = (history_log["entries"], history_log["size"])
+        self._history_unlogged = []
+        for key, created, request_hash, response in snapshot["idempotency_requests"]:
+            if key not in self.idempotency_cache:
+                self.idempotency_cache.put(key, response, request_hash=request_hash, created=created)
+        return True
+
+    def _commit_due(self) -> bool:
+        if self.pending_txns == 0:
+            return False
+        if self.pending_txns >= SERVER_CONFIG.COMMIT_MAX_BATCH:
+            return True
+        return time.monotonic() - self.pending_since >= SERVER_CONFIG.COMMIT_MAX_DELAY
+
+    def _commit(self, message: str):
+        """Commit what's staged, which the state already has. Must be called
+        with the repo lock held"""
+        head = self.git_head()
+        self.git.commit(message)
+        if self.state.head == head:
+            # Not a new version: nothing that's served changes
+            self.state = self.state._replace(head=self.git_head())
+
+    @transaction()
+    def commit_pending(self):
+        """Commit every transaction appended since the last commit. A failure
+        leaves the working tree alone: the appended transactions are already
+        part of the live state."""
+        # A full reload needs HEAD to stay the merge it's loading
+        while self._reload_backlog is not None:
+            self._commit_cond.wait()
+        if self.pending_txns == 0:
+            return
+        count = self.pending_txns
+        self._instance_ledger_writer.sync()
+        if self.instance_ledger_uncommitted:
+            # A reload held back committing the include of the instance
+            # ledger; it goes along with the transactions
+            self.add_file(os.path.join("ledger", "dynamic.beancount"))
+            self.instance_ledger_uncommitted = False
+        self.add_file(self.instance_ledger_name)
+        self._commit("Automatic commit by backtab (%d transactions)" % (count,))
+        metrics.COMMITTED_TXNS.inc(count)
+        metrics.COMMIT_BATCH_SIZE.observe(count)
+        self.pending_txns = 0
+        self.pending_since = None
+        self.committed_offset = self._instance_ledger_writer.offset
+        self.unpushed_commits += 1
+        self.save_snapshot()
+
+    def push_pending(self):
+        """Push local commits to the remote. This runs without holding the
+        repo lock, so that new transactions can be appended meanwhile."""
+        with self._push_lock:
+            if self.unpushed_commits == 0:
+                return
+            pushing = self.unpushed_commits
+            try:
+                try:
+                    self.git_cmd("git", "push")
+                except subprocess.SubprocessError:
+                    # Try pulling first
+                    metrics.PUSH_RETRIES.inc()
+                    self.pull_changes()
+                    self.git_cmd("git", "push")
+            except Exception as e:
+                metrics.PUSHES.inc(result="failed")
+                self.last_push_error = str(e)
+                raise
+            metrics.PUSHES.inc(result="ok")
+            with transaction():
+                self.unpushed_commits -= pushing
+                self.last_push = datetime.datetime.utcnow()
+                self.last_push_error = None
+
+    @transaction()
+    def commit_leftovers(self):
+        """Commit ledger changes left behind by a previous run that stopped
+        before its committer caught up. Only entries appended to the ledger
+        files get committed; if the run stopped in the middle of a write,
+        what it got to write of it is thrown away."""
+        status = self.git_output("git", "status", "--porcelain", "-z", "--untracked-files=all",
+                                 "--", "ledger").decode("utf-8")
+        recovered = []
+        for line in status.split("\0"):
+            if not line:
                 continue
-            if not bcacct.parent(entry.account) == "Liabilities:Bar:Members" and entry.account != "Assets:Cash:Bar":
-                print("Didn't load %s as it's no bar account" % (entry.account,))
+            filename = line[3:]
+            path = os.path.join(self.repo_path, filename)
+            if line.startswith("??"):
+                old_text = b""
+            elif line[:2] in (" M", "M ", "MM"):
+                old_text = self.git_output("git", "cat-file", "blob", "HEAD:" + filename)
+            else:
+                print("Not committing %s: %s" % (filename, line[:2]))
                 continue
-            acct = Member(entry.account, item_curencies=product_currencies)
-            if "display_name" in entry.meta:
-                acct.display_name = entry.meta["display_name"]
-            acct.balance = balances.get(acct.account, bcinv.Inventory())
-            accounts[acct.internal_name] = acct
-            accounts_raw[acct.account] = acct
+            with open(path, "rb") as f:
+                text = f.read()
+            length = None
+            if text.startswith(old_text):
+                length = complete_length(text[len(old_text):])
+            if length is None:
+                print("Not committing %s: it was changed other than by appending entries" % (filename,))
+                continue
+            if len(old_text) + length < len(text):
+                print("Dropping an incomplete write from %s:\n%s"
+                      % (filename, text[len(old_text) + length:].decode("utf-8", "replace")))
+                os.truncate(path, len(old_text) + length)
+                # Whatever the state was loaded from had it
+                self.state = self.state._replace(head=None)
+            self.add_file(filename)
+            recovered.append(filename)
+        if not recovered:
+            return
+        try:
+            self._commit("Automatic commit by backtab (recovered)")
+            self.unpushed_commits += 1
+        except git.NothingToCommit:
+            # All that was left was an incomplete write
+            pass
+
+    def _committer_loop(self):
+        while True:
+            try:
+                with self._commit_cond:
+                    while not self._commit_due():
+                        if self.pending_txns == 0 and self.unpushed_commits == 0:
+                            timeout = None
+                        elif self.pending_txns == 0:
+                            # Push failed earlier; retry after a delay
+                            timeout = SERVER_CONFIG.COMMIT_MAX_DELAY or 1
+                        else:
+                            timeout = max(0, self.pending_since + SERVER_CONFIG.COMMIT_MAX_DELAY - time.monotonic())
+                        if not self._commit_cond.wait(timeout) and self.pending_txns == 0:
+                            break
+                    self.commit_pending()
+                self.push_pending()
+            except Exception:
+                print("Error in committer: ")
+                traceback.print_exc()
+                time.sleep(SERVER_CONFIG.COMMIT_MAX_DELAY or 1)
+
+    def start_committer(self):
+        if self._committer is None:
+            self._committer = threading.Thread(target=self._committer_loop,
+                                               name="backtab-committer",
+                                               daemon=True)
+            self._committer.start()
+
+    def start_deferred(self, on_synchronized: typing.Optional[typing.Callable[[], None]] = None):
+        """Start without waiting for the remote: restore the state from the
+        snapshot if there is a usable one, and pull and reload in the
+        background. on_synchronized gets called once the first pull has
+        succeeded."""
+        try:
+            self.load_snapshot()
+        except Exception:
+            print("Failed to load snapshot: ")
+            traceback.print_exc()
+        # Leftovers have to be committed before anything new gets appended
+        self.commit_leftovers()
+        self.start_committer()
+        self.start_sync(initial_pull=True, on_synchronized=on_synchronized)
+
+    def _initial_pull(self, on_synchronized: typing.Optional[typing.Callable[[], None]]):
+        delay = 1
+        self.syncing = True
+        while True:
+            try:
+                self.pull_changes()
+                break
+            except Exception:
+                print("Initial pull failed: ")
+                traceback.print_exc()
+            if not self.loaded:
+                # Better to serve the local clone than nothing while the
+                # remote is unreachable
+                try:
+                    self.load_data()
+                except Exception:
+                    print("Failed to load the local clone: ")
+                    traceback.print_exc()
+            print("Retrying the pull in %ds" % (delay,))
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+        self.syncing = False
+        self.last_sync = datetime.datetime.utcnow()
+        if on_synchronized is not None:
+            on_synchronized()
 
-        # That's all the data loaded; now we update this class's fields
-        self.accounts_raw = accounts_raw
-        self.accounts = accounts
-        self.products = products
-        self.bc_options_map = options
+    def sync(self):
+        """Pull, recording the outcome for sync_status"""
+        self.syncing = True
+        try:
+            self.pull_changes()
+            self.last_sync_error = None
+        except Exception as e:
+            print("Sync failed: ")
+            traceback.print_exc()
+            self.last_sync_error = str(e)
+        finally:
+            self.syncing = False
+        self.last_sync = datetime.datetime.utcnow()
+
+    def request_sync(self):
+        """Have the sync loop pull as soon as it can, without waiting for
+        that to happen"""
+        with self._sync_cond:
+            self._sync_requested = True
+            self._sync_cond.notify()
+
+    def _sync_loop(self, initial_pull: bool,
+                   on_synchronized: typing.Optional[typing.Callable[[], None]]):
+        if initial_pull:
+            self._initial_pull(on_synchronized)
+        while True:
+            with self._sync_cond:
+                if not self._sync_requested:
+                    self._sync_cond.wait(SERVER_CONFIG.SYNC_INTERVAL or None)
+                self._sync_requested = False
+            self.sync()
 
+    def start_sync(self, initial_pull: bool = False,
+                   on_synchronized: typing.Optional[typing.Callable[[], None]] = None):
+        """Start pulling in the background, every SYNC_INTERVAL seconds and
+        whenever request_sync is called"""
+        if self._syncer is None:
+            self._syncer = threading.Thread(target=self._sync_loop,
+                                            args=(initial_pull, on_synchronized),
+                                            name="backtab-sync",
+                                            daemon=True)
+            self._syncer.start()
+
+    def flush(self):
+        """Synchronously commit and push everything that is pending"""
+        self.commit_pending()
+        self.push_pending()
+
+    def sync_status(self) -> typing.Dict:
+        """How far the instance is from the remote. This doesn't take the
+        repo lock, so that it can answer while a reload is going on; the
+        numbers may be a moment apart."""
+        try:
+            ahead, behind = self.git.ahead_behind()
+        except subprocess.SubprocessError:
+            ahead = behind = None
+        pending_since = self.pending_since
+        writer = self._instance_ledger_writer
+        return {
+            "loaded": self.loaded,
+            "synchronized": self.synchronized,
+            "syncing": self.syncing,
+            # As of the last fetch
+            "ahead": ahead,
+            "behind": behind,
+            "last_sync": str(self.last_sync) if self.last_sync else None,
+            "last_sync_error": self.last_sync_error,
+            "pending_txns": self.pending_txns,
+            "pending_age": time.monotonic() - pending_since if pending_since is not None else 0,
+            "uncommitted_bytes": writer.offset - self.committed_offset if writer is not None else 0,
+            "unpushed_commits": self.unpushed_commits,
+            "last_push": str(self.last_push) if self.last_push else None,
+            "last_push_error": self.last_push_error,
+        }
+
+    @transaction()
     def close_instance_ledger(self):
-        if self.instance_ledger is not None:
-            self.instance_ledger.close()
-            self.instance_ledger = None
+        if self._instance_ledger_writer is not None:
+            self._instance_ledger_writer.close()
+            self._instance_ledger_writer = None
 
 
 REPO_DATA = RepoData()
@@ -4,7 +4,14 @@ import typing
 import beancount.parser.printer
 import beancount.core.data as bcdata
 import beancount.core.amount as bcamount
+import click
+import codecs
+import collections
 import datetime
+import json
+import os
+import stat
+import sys
 
 product_types = dict(
     CIDER="Cider",
@@ -71,12 +78,40 @@ def to_decimal(number: typing.Union[str, float, int, bcdata.Decimal]) -> bcdata.
 
 
 def load_json(filename):
-    import json
     with open(filename, "rt") as f:
         jsons = "[" + f.read().rstrip()[:-1] + "]"
         return json.loads(jsons)
 
 
+def iter_json(filename, chunk_size=1 << 16) -> typing.Iterator[typing.Dict]:
+    """Parse the log one entry at a time, reading it in chunks. The log is
+    a sequence of JSON objects, each followed by a comma."""
+    decoder = json.JSONDecoder()
+    with open(filename, "rt") as f:
+        buffer = ""
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                buffer = f.read(chunk_size)
+                pos = 0
+                if not buffer:
+                    return
+                continue
+            try:
+                entry, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Most likely the entry continues in the next chunk
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield entry
+
+
 def member_account(member_name: str) -> str:
     if member_name == "--CASH--":
         return "Assets:Cash:Bar"
@@ -84,16 +119,137 @@ def member_account(member_name: str) -> str:
         return "Liabilities:Bar:Members:" + member_name.capitalize()
 
 
-def new_txn(entry) -> bcdata.Transaction:
-    return bcdata.Transaction(
-        meta={},
+def opening_balance_txns(initial_balances: typing.Dict[str, bcdata.Decimal]) \
+        -> typing.Iterator[bcdata.Transaction]:
+    for account, balance in initial_balances.items():
+        if balance is None:
+            continue
+        if balance == 0:
+            continue
+        txn = bcdata.Transaction(
+            meta={},
+            date=datetime.date(1970,1,1),
+            flag="txn",
+            payee="",
+            narration="Initial balance transfer for " + account,
+            tags=set(),
+            links=set(),
+            postings=[])
+        bcdata.create_simple_posting(txn, account, -balance, "EUR")
+        bcdata.create_simple_posting(txn, "Assets:InitialBalances", balance, "EUR")
+        yield txn
+
+
+# An entry of the log, with everything worked out that doesn't depend on
+# the entries before it. refs are the members to look up, as (account ID,
+# balance); accounts in postings are either an index into refs or a name.
+NormalizedEntry = collections.namedtuple("NormalizedEntry", ["type", "date", "narration", "refs", "postings"])
+
+
+def member_refs(entry) -> typing.List[typing.Tuple[int, bcdata.Decimal]]:
+    """The members that processing the entry looks up, in order, along with
+    the balance each of them is looked up with"""
+    if entry["type"] == "buy":
+        refs = entry["takefrom"][:1] + entry.get("giveto", [])
+    elif entry["type"] == "deposit":
+        refs = entry["giveto"][:1]
+    else:
+        refs = []
+    return [(ref["account_id"], to_decimal(ref["account_money"])) for ref in refs]
+
+
+def normalize_buy(entry) -> typing.List:
+    amount = to_decimal(entry["products_totalprice"])
+    if amount < 0:
+        amount = -amount
+
+    assert len(entry["takefrom"]) == 1, "More than one account in takefrom"
+
+    postings = []
+    total_giveto_amount = to_decimal(0)
+    # refs[0] is the buyer; the ones after that are the givetos
+    for i, giveto in enumerate(entry.get("giveto", []), 1):
+        giveto_amount = to_decimal(giveto["account_money_give"])
+        total_giveto_amount += giveto_amount
+        postings.append((i, -giveto_amount, "EUR"))
+    postings.append((0, amount, "EUR"))
+    postings.append(("Income:Bar", total_giveto_amount - amount, "EUR"))
+
+    products = {}
+    for product in entry["products"]:
+        product_currency = product_types_inverse[product["product_name"]]
+        products[product_currency] = products.get(product_currency, 0) + 1
+
+    assert sum(products.values()) == entry["products_amount"]
+    for product_currency, qty in products.items():
+        postings.append(("Assets:Inventory:Bar", -qty, product_currency))
+        postings.append((0, qty, product_currency))
+
+    # TODO: Report products purchased
+    return postings
+
+
+def normalize_deposit(entry) -> typing.List:
+    assert len(entry["giveto"]) == 1, "More than one giveto action in an entry"
+    amount = to_decimal(entry["giveto"][0]["give"])
+    return [
+        (0, -amount, "EUR"),
+        ("Assets:Cash:Bar", amount, "EUR"),
+    ]
+
+
+NORMALIZERS = {
+    "buy": normalize_buy,
+    "deposit": normalize_deposit,
+}
+
+
+def normalize_entry(entry) -> NormalizedEntry:
+    normalizer = NORMALIZERS.get(entry["type"])
+    if normalizer is None:
+        return NormalizedEntry(entry["type"], None, None, [], [])
+    return NormalizedEntry(
+        type=entry["type"],
         date=datetime.datetime.fromtimestamp(entry["timestamp"]).date(),
-        flag="txn",
-        payee="",
         narration=entry["human"],
-        tags=set(),
-        links=set(),
-        postings=[])
+        refs=member_refs(entry),
+        postings=normalizer(entry),
+    )
+
+
+def normalize_file(filename: str) -> typing.Tuple[typing.Dict[int, str], typing.List[NormalizedEntry]]:
+    """Parse and normalize a whole log. Returns the account names by ID
+    as of the end of the log, along with the normalized entries."""
+    accounts_by_id = {}
+    entries = []
+    for entry in iter_json(filename):
+        for acct in entry.get("giveto", []) + entry.get("takefrom", []):
+            accounts_by_id[acct["account_id"]] = member_account(acct["account_name"])
+        entries.append(normalize_entry(entry))
+    return accounts_by_id, entries
+
+
+class EntryWriter:
+    """Writes entries one at a time, with the same output as
+    beancount.parser.printer.print_entries gives for all of them at once"""
+
+    def __init__(self, output=None):
+        self.output = output or codecs.getwriter("utf-8")(sys.stdout.buffer)
+        self.previous_type = None
+        self.printer = beancount.parser.printer.EntryPrinter()
+
+    def write(self, entries: typing.Iterable[bcdata.Directive]):
+        for entry in entries:
+            entry_type = type(entry)
+            if self.previous_type is None:
+                self.previous_type = entry_type
+            # Insert a newline between transactions and between blocks of
+            # directives of the same type.
+            if (entry_type in (bcdata.Transaction, bcdata.Commodity) or
+                    entry_type is not self.previous_type):
+                self.output.write('\n')
+                self.previous_type = entry_type
+            self.output.write(self.printer(entry))
 
 
 class Processor:
@@ -152,93 +308,102 @@ class Processor:
             self.last_assertion[name] = date
         return name
 
-    def process_buy(self, entry):
-        txn = new_txn(entry)
-        amount = to_decimal(entry["products_totalprice"])
-        if amount < 0:
-            amount = -amount
-
-        assert len(entry["takefrom"]) == 1, "More than one account in takefrom"
-
-        takefrom = entry["takefrom"][0]
-        initial_balance = to_decimal(takefrom["account_money"])
-        account_name = self.get_member(takefrom["account_id"], takefrom["account_name"], txn.date, initial_balance)
-
-        total_giveto_amount = to_decimal(0)
-        if "giveto" in entry:
-            for giveto in entry["giveto"]:
-                giveto_account = self.get_member(giveto["account_id"], giveto["account_name"], txn.date,
-                                                 to_decimal(giveto["account_money"]))
-                giveto_amount = to_decimal(giveto["account_money_give"])
-                total_giveto_amount += giveto_amount
-                bcdata.create_simple_posting(txn, giveto_account, -giveto_amount, "EUR")
-        bcdata.create_simple_posting(txn, account_name, amount, "EUR")
-        bcdata.create_simple_posting(txn, "Income:Bar", total_giveto_amount - amount, "EUR")
-
-
-        products = {}
-        for product in entry["products"]:
-            product_currency = product_types_inverse[product["product_name"]]
-            products[product_currency] = products.get(product_currency, 0) + 1
-
-        assert sum(products.values()) == entry["products_amount"]
-        for product_currency, qty in products.items():
-            bcdata.create_simple_posting(txn, "Assets:Inventory:Bar", -qty, product_currency)
-            bcdata.create_simple_posting(txn, account_name, qty, product_currency)
-
-        # TODO: Report products purchased
-
-        self.entries.append(txn)
-
-    def process_deposit(self, entry):
-        txn = new_txn(entry)
-        assert len(entry["giveto"]) == 1, "More than one giveto action in an entry"
-        giveto = entry["giveto"][0]
-        amount = to_decimal(giveto["give"])
-        initial_balance = to_decimal(giveto['account_money'])
-        account = self.get_member(giveto["account_id"], giveto["account_name"], txn.date, initial_balance)
-
-        bcdata.create_simple_posting(txn, account, -amount, "EUR")
-        bcdata.create_simple_posting(txn, "Assets:Cash:Bar", amount, "EUR")
-        self.entries.append(txn)
-
-    def process_check(self, entry):
-        pass
+    def process_normalized(self, entry: NormalizedEntry):
+        self.line += 1
+        if entry.type in NORMALIZERS:
+            # Looking up the members is what depends on the entries before
+            # this one, so it has to happen in order
+            accounts = [self.get_member(account_id, None, entry.date, balance)
+                        for account_id, balance in entry.refs]
+            txn = bcdata.Transaction(
+                meta={},
+                date=entry.date,
+                flag="txn",
+                payee="",
+                narration=entry.narration,
+                tags=set(),
+                links=set(),
+                postings=[])
+            for account, number, currency in entry.postings:
+                if isinstance(account, int):
+                    account = accounts[account]
+                bcdata.create_simple_posting(txn, account, number, currency)
+            self.entries.append(txn)
+        elif entry.type != "check":
+            print("Could not process entry type %s\n" % (entry.type,), file=sys.stderr)
 
     def process_entry(self, entry):
-        self.line += 1
-        proc = getattr(self, "process_" + entry["type"], None)
-        if proc is None:
-            print("Could not process entry type %s\n" % (entry["type"],), file=sys.stderr)
-        else:
-            return proc(entry)
+        self.process_normalized(normalize_entry(entry))
+
+    def scan_accounts(self, entry):
+        for acct in entry.get("giveto", []) + entry.get("takefrom", []):
+            self.accounts_by_id[acct["account_id"]] = member_account(acct["account_name"])
 
     def process_json(self, json):
         # Start by computing account IDs
         for entry in json:
-            for acct in entry.get("giveto", []) + entry.get("takefrom", []):
-                self.accounts_by_id[acct["account_id"]] = member_account(acct["account_name"])
+            self.scan_accounts(entry)
         for entry in json:
             self.process_entry(entry)
 
+    def process_files(self, filenames: typing.List[str], jobs: int = 1):
+        """Convert several logs as if they were one. With more than one job,
+        the files are parsed and normalized in parallel, and only the
+        member lookups happen in order."""
+        if jobs > 1 and len(filenames) > 1:
+            import concurrent.futures
+            with concurrent.futures.ProcessPoolExecutor(min(jobs, len(filenames))) as pool:
+                results = list(pool.map(normalize_file, filenames))
+        else:
+            results = [normalize_file(filename) for filename in filenames]
+        for accounts_by_id, _ in results:
+            self.accounts_by_id.update(accounts_by_id)
+        for _, entries in results:
+            for entry in entries:
+                self.process_normalized(entry)
+
+    def scan_files(self, filenames: typing.List[str]) -> typing.Dict[str, bcdata.Decimal]:
+        """The first pass of a streaming conversion: compute the account IDs,
+        and from those, the initial balances that process_entry will find.
+        Those are needed before the first entry gets written."""
+        # For every account ID, the first balance it's seen with
+        first_seen = {}
+        for filename in filenames:
+            for entry in iter_json(filename):
+                self.scan_accounts(entry)
+                for account_id, balance in member_refs(entry):
+                    first_seen.setdefault(account_id, balance)
+        initial_balances = {}
+        for account_id, balance in first_seen.items():
+            initial_balances.setdefault(self.accounts_by_id[account_id], balance)
+        return initial_balances
+
+    def stream_files(self, filenames: typing.List[str], writer: EntryWriter, jobs: int = 1):
+        """Convert the logs with bounded memory, writing the entries as they
+        are produced. The files are read twice, so they can't be pipes.
+        With more than one job, whole files are normalized in parallel, so
+        memory use is bounded by the size of the files instead."""
+        initial_balances = self.scan_files(filenames)
+        writer.write(opening_balance_txns(initial_balances))
+        if jobs > 1 and len(filenames) > 1:
+            import concurrent.futures
+            with concurrent.futures.ProcessPoolExecutor(min(jobs, len(filenames))) as pool:
+                for _, entries in pool.map(normalize_file, filenames):
+                    for entry in entries:
+                        self.process_normalized(entry)
+                        writer.write(self.entries)
+                        self.entries.clear()
+        else:
+            for filename in filenames:
+                for entry in iter_json(filename):
+                    self.process_entry(entry)
+                    writer.write(self.entries)
+                    self.entries.clear()
+        if initial_balances != self.initial_balances:
+            raise AssertionError("Initial balances changed during conversion")
+
     def transfer_opening_balances(self):
-        for account, balance in self.initial_balances.items():
-            if balance is None:
-                continue
-            if balance == 0:
-                continue
-            txn = bcdata.Transaction(
-                meta={},
-                date=datetime.date(1970,1,1),
-                flag="txn",
-                payee="",
-                narration="Initial balance transfer for " + account,
-                tags=set(),
-                links=set(),
-                postings=[])
-            bcdata.create_simple_posting(txn, account, -balance, "EUR")
-            bcdata.create_simple_posting(txn, "Assets:InitialBalances", balance, "EUR")
-            yield txn
+        return opening_balance_txns(self.initial_balances)
 
     def print_results(self):
         open_accounts = [
@@ -251,11 +416,30 @@ class Processor:
         beancount.parser.printer.print_entries(opening_balances + entries)
 
 
-def main():
+@click.command()
+@click.option("--stream", is_flag=True,
+              help="Convert with bounded memory. The inputs must be files, not pipes")
+@click.option("-j", "--jobs", default=os.cpu_count() or 1,
+              help="Processes to parse and normalize the inputs with, one file at a time")
+@click.argument("inputs", nargs=-1, type=click.Path(dir_okay=False, exists=True))
+def main(stream, jobs, inputs):
+    """Convert spacebar logs to a beancount ledger. Several logs (e.g., one
+    per year) are converted as if they were concatenated, in the order
+    given. Without inputs, the log is read from stdin."""
+    inputs = list(inputs) or ["/dev/stdin"]
     proc = Processor()
-    proc.process_json(load_json("/dev/stdin"))
-    proc.print_results()
-
+    if stream:
+        for filename in inputs:
+            if not stat.S_ISREG(os.stat(filename).st_mode):
+                raise click.BadParameter("Streaming needs to read the inputs twice; use files",
+                                         param_hint="INPUTS")
+        proc.stream_files(inputs, EntryWriter(), jobs=jobs)
+    elif len(inputs) == 1 and jobs == 1:
+        proc.process_json(load_json(inputs[0]))
+        proc.print_results()
+    else:
+        proc.process_files(inputs, jobs=jobs)
+        proc.print_results()
 
 glbls = globals()
 
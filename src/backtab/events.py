@@ -0,0 +1,46 @@
+# Broadcasting of state changes to streaming clients
+
+import collections
+import threading
+import typing
+
+Event = collections.namedtuple("Event", ["id", "kind", "data"])
+
+
+class EventBroker:
+    """Keeps a short backlog of recent events, so that clients that
+    reconnect with the last event ID they saw don't miss anything"""
+    _cond: threading.Condition
+    _events: typing.Deque[Event]
+    last_id: int
+
+    def __init__(self, backlog: int = 256):
+        self._cond = threading.Condition()
+        self._events = collections.deque(maxlen=backlog)
+        self.last_id = 0
+
+    def publish(self, kind: str, data: typing.Dict) -> Event:
+        with self._cond:
+            self.last_id += 1
+            event = Event(self.last_id, kind, data)
+            self._events.append(event)
+            self._cond.notify_all()
+        return event
+
+    def wait(self, after: int, timeout: typing.Optional[float] = None) -> typing.List[Event]:
+        """Return the events following the one with ID after, waiting up to
+        timeout seconds for one to arrive. If some of them are no longer in
+        the backlog, the client needs to start over; it gets a single reload
+        event instead."""
+        with self._cond:
+            if after > self.last_id:
+                # The client saw events from before we (re)started
+                return [Event(self.last_id, "reload", {})]
+            if not self._cond.wait_for(lambda: self.last_id > after, timeout):
+                return []
+            if self._events[0].id > after + 1:
+                return [Event(self.last_id, "reload", {})]
+            return [event for event in self._events if event.id > after]
+
+
+BROKER = EventBroker()
@@ -0,0 +1,173 @@
+# Access to the data repo's git repository
+#
+# Everything that talks to the remote (push, pull, fetch) always runs the
+# git binary; only the local operations that happen for every transaction
+# batch have an in-process implementation.
+
+from backtab import metrics
+import contextlib
+import os.path
+import subprocess
+import typing
+
+
+class GitError(subprocess.SubprocessError):
+    pass
+
+
+class NothingToCommit(GitError):
+    """The index doesn't differ from HEAD"""
+    pass
+
+
+class SubprocessGit:
+    """Runs the git binary for every operation"""
+    name = "subprocess"
+    repo_path: str
+
+    def __init__(self, repo_path: str):
+        self.repo_path = repo_path
+
+    @contextlib.contextmanager
+    def _timed(self, command: str, backend: typing.Optional[str] = None):
+        """Record the time taken by a git subcommand in the metrics. backend
+        is what ran it; the git binary runs for some operations whichever
+        backend is in use"""
+        backend = backend or self.name
+        try:
+            with metrics.GIT_SECONDS.time(command=command, backend=backend):
+                yield
+        except Exception:
+            metrics.GIT_ERRORS.inc(command=command, backend=backend)
+            raise
+
+    def run(self, *args: str):
+        print("\x1b[1;31mGit command: \x1b[0m" + " ".join(("git",) + args))
+        with self._timed(args[0], backend=SubprocessGit.name):
+            subprocess.run(["git"] + list(args),
+                           cwd=self.repo_path,
+                           check=True)
+
+    def output(self, *args: str) -> bytes:
+        with self._timed(args[0], backend=SubprocessGit.name):
+            return subprocess.check_output(["git"] + list(args), cwd=self.repo_path)
+
+    def head(self) -> str:
+        return self.output("rev-parse", "HEAD").decode("utf-8").strip()
+
+    def add(self, *paths: str):
+        self.run("add", *paths)
+
+    def commit(self, message: str):
+        try:
+            self.run("commit", "-m", message)
+        except subprocess.CalledProcessError:
+            if subprocess.run(["git", "diff", "--cached", "--quiet"], cwd=self.repo_path).returncode == 0:
+                raise NothingToCommit("Nothing to commit")
+            raise
+
+    def reset_hard(self, rev: str):
+        self.run("reset", "--hard", rev)
+
+    def reset_merge(self, rev: str):
+        """Move HEAD and the working tree back to rev, keeping uncommitted
+        changes; this fails rather than throw any of them away"""
+        self.run("reset", "--merge", rev)
+
+    def fetch(self):
+        try:
+            with self._timed("fetch", backend=SubprocessGit.name):
+                subprocess.run(["git", "fetch", "--quiet"],
+                               cwd=self.repo_path,
+                               stderr=subprocess.PIPE,
+                               check=True)
+        except subprocess.CalledProcessError as e:
+            raise GitError(e.stderr.decode("utf-8", "replace"))
+
+    def merge_upstream(self):
+        """Merge the fetched upstream changes, leaving the working tree
+        untouched if that fails"""
+        try:
+            with self._timed("merge", backend=SubprocessGit.name):
+                subprocess.run("git merge --no-edit '@{upstream}' "
+                               "|| ( git merge --abort; false; )",
+                               shell=True,
+                               cwd=self.repo_path,
+                               stderr=subprocess.PIPE,
+                               check=True)
+        except subprocess.CalledProcessError as e:
+            raise GitError(e.stderr.decode("utf-8", "replace"))
+
+    def ahead_behind(self) -> typing.Tuple[int, int]:
+        """How many commits HEAD has that upstream doesn't, and the other
+        way around, as of the last fetch"""
+        ahead, behind = self.output("rev-list", "--left-right", "--count", "HEAD...@{upstream}").split()
+        return int(ahead), int(behind)
+
+
+class DulwichGit(SubprocessGit):
+    """Does the local operations in-process using dulwich, which saves
+    several process spawns per commit"""
+    name = "dulwich"
+
+    def __init__(self, repo_path: str):
+        super(DulwichGit, self).__init__(repo_path)
+        import dulwich.repo
+        self._repo = dulwich.repo.Repo(repo_path)
+
+    def _worktree(self):
+        # Newer versions of dulwich moved the working tree operations out
+        # of Repo
+        if hasattr(self._repo, "get_worktree"):
+            return self._repo.get_worktree()
+        return self._repo
+
+    def head(self) -> str:
+        with self._timed("rev-parse"):
+            return self._repo.head().decode("ascii")
+
+    def add(self, *paths: str):
+        print("\x1b[1;31mGit (dulwich): \x1b[0madd " + " ".join(paths))
+        files = []
+        for path in paths:
+            path = os.path.join(self.repo_path, path)
+            if os.path.isdir(path):
+                for dirpath, _, filenames in os.walk(path):
+                    files.extend(os.path.join(dirpath, filename) for filename in filenames)
+            else:
+                files.append(path)
+        # Staging the files directly skips the status scan porcelain.add does
+        with self._timed("add"):
+            self._worktree().stage([os.path.relpath(path, self.repo_path) for path in files])
+
+    def commit(self, message: str):
+        print("\x1b[1;31mGit (dulwich): \x1b[0mcommit -m " + message)
+        with self._timed("commit"):
+            # git refuses to make empty commits; so do we
+            index_tree = self._repo.open_index().commit(self._repo.object_store)
+            if index_tree == self._repo[self._repo.head()].tree:
+                raise NothingToCommit("Nothing to commit")
+            self._worktree().commit(message=message.encode("utf-8"), tree=index_tree)
+
+    def reset_hard(self, rev: str):
+        import dulwich.porcelain
+        print("\x1b[1;31mGit (dulwich): \x1b[0mreset --hard " + rev)
+        with self._timed("reset"):
+            dulwich.porcelain.reset(self._repo, "hard", rev)
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in [SubprocessGit, DulwichGit]
+}
+
+
+def open_repo(repo_path: str, backend: str = "auto") -> SubprocessGit:
+    """Open the repo with the named backend. "auto" picks dulwich if it is
+    installed, and falls back to the git binary otherwise"""
+    if backend == "auto":
+        try:
+            return DulwichGit(repo_path)
+        except ImportError:
+            return SubprocessGit(repo_path)
+    return BACKENDS[backend](repo_path)
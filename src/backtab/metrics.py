@@ -0,0 +1,186 @@
+# Counters, gauges and latency histograms, exported in the Prometheus text format
+
+import contextlib
+import threading
+import time
+import typing
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+LabelValues = typing.Tuple[typing.Tuple[str, str], ...]
+
+
+def _format_labels(labels: LabelValues, extra: typing.Optional[typing.Tuple[str, str]] = None) -> str:
+    if extra is not None:
+        labels = labels + (extra,)
+    if not labels:
+        return ""
+    return "{%s}" % (",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels),)
+
+
+class Metric:
+    name: str
+    help: str
+    type: str
+    _lock: threading.Lock
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+
+    def render(self) -> typing.List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+    _values: typing.Dict[LabelValues, float]
+
+    def __init__(self, name: str, help: str):
+        super(Counter, self).__init__(name, help)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> typing.List[str]:
+        with self._lock:
+            return ["%s%s %s" % (self.name, _format_labels(labels), value)
+                    for labels, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    type = "gauge"
+    _values: typing.Dict[LabelValues, float]
+
+    def __init__(self, name: str, help: str):
+        super(Gauge, self).__init__(name, help)
+        self._values = {}
+
+    def set(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+    def render(self) -> typing.List[str]:
+        with self._lock:
+            return ["%s%s %s" % (self.name, _format_labels(labels), value)
+                    for labels, value in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    type = "histogram"
+    buckets: typing.Tuple[float, ...]
+    # Per set of labels: the (non-cumulative) count per bucket, with one
+    # extra for +Inf, followed by the sum
+    _values: typing.Dict[LabelValues, typing.List]
+
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe how long the body of the with statement takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> typing.List[str]:
+        lines = []
+        with self._lock:
+            for labels, counts in sorted(self._values.items()):
+                total = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    total += count
+                    lines.append("%s_bucket%s %d" % (self.name, _format_labels(labels, ("le", str(bound))), total))
+                lines.append("%s_sum%s %s" % (self.name, _format_labels(labels), counts[-1]))
+                lines.append("%s_count%s %d" % (self.name, _format_labels(labels), total))
+        return lines
+
+
+class Registry:
+    _metrics: typing.List[Metric]
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        metric = Counter(name, help)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        metric = Gauge(name, help)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "backtab_http_requests_total", "HTTP requests by route, method and status")
+HTTP_SECONDS = REGISTRY.histogram(
+    "backtab_http_request_seconds", "Time spent handling HTTP requests, by route")
+RENDER_SECONDS = REGISTRY.histogram(
+    "backtab_render_seconds", "Time spent rendering cached JSON responses")
+GIT_SECONDS = REGISTRY.histogram(
+    "backtab_git_command_seconds", "Time spent in git, by subcommand and backend")
+GIT_ERRORS = REGISTRY.counter(
+    "backtab_git_command_errors_total", "Failed git commands, by subcommand and backend")
+PULL_SECONDS = REGISTRY.histogram(
+    "backtab_pull_seconds", "Time spent in pull_changes, by how the state was reloaded")
+LOAD_PHASE_SECONDS = REGISTRY.histogram(
+    "backtab_load_phase_seconds", "Time spent in each phase of loading the repo state")
+LOCK_WAIT_SECONDS = REGISTRY.histogram(
+    "backtab_lock_wait_seconds", "Time spent waiting for the repo lock")
+LOCK_HOLD_SECONDS = REGISTRY.histogram(
+    "backtab_lock_hold_seconds", "Time the repo lock was held")
+PUSHES = REGISTRY.counter(
+    "backtab_pushes_total", "Pushes to the remote, by result")
+PUSH_RETRIES = REGISTRY.counter(
+    "backtab_push_retries_total", "Pushes that were rejected and retried after a pull")
+COMMITTED_TXNS = REGISTRY.counter(
+    "backtab_committed_transactions_total", "Transactions committed to git")
+COMMIT_BATCH_SIZE = REGISTRY.histogram(
+    "backtab_commit_batch_size", "Transactions per commit",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+IDEMPOTENT_REPLAYS = REGISTRY.counter(
+    "backtab_idempotent_replays_total", "Transaction requests answered from the idempotency cache")
+STARTUP_SECONDS = REGISTRY.gauge(
+    "backtab_startup_seconds", "Seconds from the start of the server until each startup phase was reached")
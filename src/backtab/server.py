@@ -1,33 +1,183 @@
+import time
+# Origin of the startup metrics; everything else gets imported after this
+STARTED = time.perf_counter()
+
 import bottle
 import click
+import concurrent.futures
+import datetime
 import decimal
+import hashlib
+import json
+import re
 import sdnotify
+import signal
+import sys
 from backtab.config import SERVER_CONFIG
-from backtab import data_repo
-from backtab.data_repo import REPO_DATA, UpdateFailed
+from backtab import data_repo, metrics
+from backtab.data_repo import REPO_DATA
+from backtab.events import BROKER
 from functools import wraps
 import typing
-import traceback
-import time
+import socketserver
+import wsgiref.simple_server
 api = bottle.Bottle()
 
+# Seconds between keepalive comments on idle event streams
+EVENT_KEEPALIVE = 15
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    """Serve each connection in its own thread, so that event streams don't
+    hold up other requests"""
+    daemon_threads = True
+
+
+class PooledWSGIServer(wsgiref.simple_server.WSGIServer):
+    """Serve connections from a fixed pool of worker threads"""
+    _pool: concurrent.futures.ThreadPoolExecutor
+
+    def __init__(self, *args, **kwargs):
+        super(PooledWSGIServer, self).__init__(*args, **kwargs)
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=SERVER_CONFIG.HTTP_WORKERS,
+            thread_name_prefix="backtab-http")
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super(PooledWSGIServer, self).server_close()
+        self._pool.shutdown(wait=False)
+
+
+# Servers that handle one request at a time; an open event stream would
+# keep every other request waiting
+SINGLE_THREADED_SERVERS = {"wsgiref"}
+
+
+def run_server(app):
+    """Run the HTTP server selected in the config"""
+    options = {}
+    if SERVER_CONFIG.HTTP_SERVER == "threaded":
+        server = "wsgiref"
+        options["server_class"] = ThreadingWSGIServer
+    elif SERVER_CONFIG.HTTP_SERVER == "pool":
+        server = "wsgiref"
+        options["server_class"] = PooledWSGIServer
+    else:
+        server = SERVER_CONFIG.HTTP_SERVER
+    bottle.run(app, server=server,
+               host=SERVER_CONFIG.LISTEN_ADDR, port=SERVER_CONFIG.PORT,
+               **options)
+
+
+def measure_requests(callback):
+    """Bottle plugin that records the request count and latency of each
+    route in the metrics"""
+    @wraps(callback)
+    def wrapper(*args, **kwargs):
+        route = bottle.request.route.rule
+        status = 500
+        start = time.perf_counter()
+        try:
+            result = callback(*args, **kwargs)
+            status = bottle.response.status_code
+            return result
+        except bottle.HTTPResponse as e:
+            status = e.status_code
+            raise
+        finally:
+            metrics.HTTP_SECONDS.observe(time.perf_counter() - start, route=route)
+            metrics.HTTP_REQUESTS.inc(route=route, method=bottle.request.method, status=status)
+    return wrapper
+
+
+# Routes that work before there is any state to serve from
+STARTUP_ROUTES = {"/ping", "/admin/status", "/admin/metrics"}
+
+
+def require_state(callback):
+    """Bottle plugin that answers 503 while a deferred startup hasn't
+    loaded any state yet"""
+    @wraps(callback)
+    def wrapper(*args, **kwargs):
+        if not REPO_DATA.loaded and bottle.request.route.rule not in STARTUP_ROUTES:
+            raise bottle.HTTPError(503, "Starting up", Retry_After="1")
+        return callback(*args, **kwargs)
+    return wrapper
+
+
+api.install(require_state)
+api.install(measure_requests)
+
 
 @api.get("/ping")
 def ping():
     return "ok"
 
+# Rendered responses by name, as (state version, etag, body)
+_response_cache: typing.Dict[str, typing.Tuple[int, str, bytes]] = {}
+
+
+def cached_json(fn: typing.Callable[[data_repo.RepoState], typing.Dict]):
+    """Serve the JSON that fn renders from the repo state, re-rendering it
+    only when the state has changed. Clients that send the current ETag
+    back in If-None-Match get a 304 response instead."""
+    @wraps(fn)
+    def result():
+        state = REPO_DATA.state
+        version = state.version
+        cached = _response_cache.get(fn.__name__)
+        if cached is None or cached[0] != version:
+            with metrics.RENDER_SECONDS.time(response=fn.__name__):
+                body = json.dumps(fn(state)).encode("utf-8")
+            etag = '"%s"' % (hashlib.sha1(body).hexdigest(),)
+            cached = _response_cache[fn.__name__] = (version, etag, body)
+        _, etag, body = cached
+
+        bottle.response.set_header("ETag", etag)
+        bottle.response.set_header("Cache-Control", "no-cache")
+        if_none_match = bottle.request.get_header("If-None-Match", "")
+        if if_none_match.strip() == "*" or etag in (
+                tag.strip().replace("W/", "", 1) for tag in if_none_match.split(",")):
+            bottle.response.status = 304
+            return b""
+        bottle.response.content_type = "application/json"
+        return body
+    return result
+
+
 @api.get("/products")
 def products():
     time.sleep(SERVER_CONFIG.SLOWDOWN)
+    return render_products()
+
+
+@cached_json
+def render_products(state: data_repo.RepoState):
     return {
         name: product.to_json()
-        for name, product in filter(lambda item: item[1].visible, REPO_DATA.products.items())
+        for name, product in filter(lambda item: item[1].visible, state.products.items())
     }
 
 
 @api.get("/accounts")
 def accounts():
     time.sleep(SERVER_CONFIG.SLOWDOWN)
+    return render_accounts()
+
+
+@cached_json
+def render_accounts(state: data_repo.RepoState):
     return {
         name: {
             "display_name": member.display_name,
@@ -36,47 +186,295 @@ def accounts():
             "balance": str(-member.balance_eur),
             "items": member.item_count,
         }
-        for name, member in REPO_DATA.accounts.items()
+        for name, member in state.accounts.items()
+    }
+
+
+# Most entries a single history request returns
+HISTORY_PAGE_MAX = 500
+
+
+def history_entry_json(entry: data_repo.HistoryEntry) -> typing.Dict:
+    changes = dict(entry.changes)
+    return {
+        "date": entry.date,
+        "timestamp": entry.timestamp,
+        "type": entry.type,
+        "description": entry.narration,
+        # From the member's viewpoint, like the balance in /accounts
+        "amount": str(-data_repo.Cents(changes.pop("EUR", 0))),
+        "items": changes,
+    }
+
+
+@api.get("/accounts/<name>/history")
+def history(name):
+    """A member's transactions, newest first. Pass the "next" cursor of a
+    response as ?cursor= to get the page after it; a cursor goes stale
+    (410) when the history gets rebuilt, after which the client should
+    start over."""
+    time.sleep(SERVER_CONFIG.SLOWDOWN)
+    state = REPO_DATA.state
+    member = state.accounts.get(name)
+    if member is None:
+        raise bottle.HTTPError(404, "No such member")
+    if state.history is None:
+        state = REPO_DATA.load_history()
+        if state.history is None:
+            raise bottle.HTTPError(503, "The history is unavailable until the next reload")
+    try:
+        limit = int(bottle.request.query.get("limit", 50))
+        if not 0 < limit <= HISTORY_PAGE_MAX:
+            raise ValueError("Limit out of range", limit)
+        entries, cursor = data_repo.history_page(state, member.account, bottle.request.query.get("cursor"), limit)
+    except data_repo.StaleCursor:
+        raise bottle.HTTPError(410, "The history has been reloaded since; start over")
+    except ValueError as e:
+        raise bottle.HTTPError(400, "Invalid request: %r" % (e,))
+    return {
+        "entries": [history_entry_json(entry) for entry in entries],
+        "next": cursor,
+    }
+
+
+# Most days a single stats request covers
+STATS_MAX_DAYS = 366
+
+
+def day_stats_json(day_stats: data_repo.DayStats) -> typing.Dict:
+    return {
+        "products": {
+            currency: {"units": units, "amount": str(data_repo.Cents(cents))}
+            for currency, (units, cents) in sorted(day_stats.products.items())
+        },
+        "paybacks": {
+            account: str(data_repo.Cents(cents))
+            for account, cents in sorted(day_stats.paybacks.items())
+        },
+    }
+
+
+@api.get("/stats")
+def stats():
+    """Units sold and revenue per product, and what's owed to each payback
+    account, per day (or per week with ?by=week) from ?from= to ?to=, both
+    inclusive and as YYYY-MM-DD. Defaults to the last week, by day.
+
+    Only transactions with type "purchase" count, so days rolled into a
+    checkpoint and history imported from spacebar show no sales."""
+    time.sleep(SERVER_CONFIG.SLOWDOWN)
+    state = REPO_DATA.state
+    query = bottle.request.query
+    try:
+        last = datetime.date.fromisoformat(query["to"]) if "to" in query else datetime.datetime.utcnow().date()
+        first = datetime.date.fromisoformat(query["from"]) if "from" in query else last - datetime.timedelta(days=6)
+        by = query.get("by", "day")
+        if by not in ("day", "week"):
+            raise ValueError("Invalid period", by)
+        if not 0 <= (last - first).days < STATS_MAX_DAYS:
+            raise ValueError("Range out of bounds", first, last)
+    except ValueError as e:
+        raise bottle.HTTPError(400, "Invalid request: %r" % (e,))
+    periods, total = data_repo.sales_stats(state, first, last, weekly=by == "week")
+    return {
+        "from": first.isoformat(),
+        "to": last.isoformat(),
+        "by": by,
+        "periods": [dict(start=start.isoformat(), **day_stats_json(day_stats)) for start, day_stats in periods],
+        "total": day_stats_json(total),
     }
 
 
 @api.get("/admin/update")
 def update():
+    """Have the instance pull from the remote soon. This doesn't wait for
+    the pull; poll /admin/status to see when it's done."""
     time.sleep(SERVER_CONFIG.SLOWDOWN)
+    REPO_DATA.request_sync()
+    status = REPO_DATA.sync_status()
+    status["sync_requested"] = True
+    return status
+
+
+@api.get("/admin/status")
+def status():
+    return REPO_DATA.sync_status()
+
+
+@api.get("/admin/metrics")
+def metrics_endpoint():
+    """Counters and latency histograms in the Prometheus text format"""
+    bottle.response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+    return metrics.REGISTRY.render()
+
+
+@api.get("/events")
+def events():
+    """Stream state changes as server-sent events. "txn" events carry the
+    same payload as the response to the transaction; after a "reload"
+    event, clients should refetch /accounts. Not available with a
+    single-threaded server."""
+    if SERVER_CONFIG.HTTP_SERVER in SINGLE_THREADED_SERVERS:
+        raise bottle.HTTPError(501, "Event streams need a server that handles requests concurrently")
+    after = bottle.request.get_header("Last-Event-ID") or bottle.request.query.get("last_id")
     try:
-        REPO_DATA.pull_changes()
-        return "Success"
-    except UpdateFailed as e:
-        raise bottle.HTTPResponse(body=traceback.format_exc())
+        after = int(after) if after else BROKER.last_id
+    except ValueError:
+        raise bottle.HTTPError(400, "Invalid Last-Event-ID")
+    bottle.response.content_type = "text/event-stream"
+    bottle.response.set_header("Cache-Control", "no-cache")
+
+    def stream(after):
+        yield "retry: 1000\n\n"
+        while True:
+            events = BROKER.wait(after, timeout=EVENT_KEEPALIVE)
+            if not events:
+                # Lets us notice clients that went away
+                yield ": keepalive\n\n"
+            for event in events:
+                yield "id: %d\nevent: %s\ndata: %s\n\n" % (
+                    event.id, event.kind, json.dumps(event.data))
+                after = event.id
+    return stream(after)
+
+
+# Transaction builders by name, as registered by json_txn_method
+TXN_TYPES: typing.Dict[str, typing.Callable[[typing.Dict], data_repo.Transaction]] = {}
+
+
+def txn_response(txns: typing.List[data_repo.Transaction],
+                 member_deltas: typing.List[data_repo.Member]) -> typing.Dict:
+    # Members are replaced rather than updated, so the primary accounts
+    # of the txns still have the old balances. member_deltas has the
+    # balances after all of txns; work back from those to the balance
+    # after each of them
+    balances = {member.account: member.balance_cents for member in member_deltas}
+    messages = []
+    for txn in reversed(txns):
+        message = txn.beancount_txn.narration
+        if txn.primary_account is not None:
+            account = txn.primary_account.account
+            # Unless nothing changed it
+            balances.setdefault(account, txn.primary_account.balance_cents)
+            message += " (and now has €%s)" % (-data_repo.Cents(balances[account]),)
+            balances[account] -= sum(leg.units for leg in txn.legs
+                                     if leg.account == account and leg.currency == "EUR")
+        messages.append(message)
+    messages.reverse()
+    return {
+        "members": {
+            member.internal_name: member.balance_json()
+            for member in member_deltas
+        },
+        "message": "\n".join(messages),
+    }
+
+
+# Idempotency keys end up in the ledger, so they're kept simple; a UUID
+# will do
+IDEMPOTENCY_KEY_RE = re.compile(r"^[A-Za-z0-9_.:-]{1,100}$")
+
+
+def request_hash() -> str:
+    """Identifies what the request asks for, so that a retry can be told
+    apart from a different request that reuses its idempotency key"""
+    try:
+        body = json.dumps(bottle.request.json, sort_keys=True, separators=(",", ":"))
+    except ValueError:
+        body = bottle.request.body.read().decode("utf-8", "replace")
+    return hashlib.sha256((bottle.request.path + "\n" + body).encode("utf-8")).hexdigest()
+
+
+def apply_idempotently(make_txns: typing.Callable[[], typing.List[data_repo.Transaction]],
+                       respond: typing.Callable[[typing.List[data_repo.Transaction], typing.List[data_repo.Member]],
+                                                typing.Dict]) -> typing.Dict:
+    """Apply the transactions from make_txns, and return the response that
+    respond makes of them. If the request has an Idempotency-Key header, a
+    retry with the same key gets the response to the first request instead,
+    and nothing gets applied again; reusing the key for a different request
+    gets a 422."""
+    key = bottle.request.get_header("Idempotency-Key")
+    if key is None:
+        txns = make_txns()
+        response = respond(txns, REPO_DATA.apply_txns(txns))
+    else:
+        if not IDEMPOTENCY_KEY_RE.match(key):
+            raise bottle.HTTPError(400, "Invalid Idempotency-Key")
+        this_request = request_hash()
+        # Held throughout, so that concurrent retries can't both get applied
+        with data_repo.transaction():
+            known = REPO_DATA.idempotency_cache.get(key)
+            if known is not None:
+                known_request, response = known
+                # Requests from ledgers written before hashes were recorded
+                # have none
+                if known_request is not None and known_request != this_request:
+                    raise bottle.HTTPError(422, "Idempotency-Key was already used for a different request")
+                metrics.IDEMPOTENT_REPLAYS.inc()
+                bottle.response.set_header("Idempotent-Replayed", "true")
+                return response
+            txns = make_txns()
+            for txn in txns:
+                txn.meta["idempotency_key"] = key
+                txn.meta["request_hash"] = this_request
+            response = respond(txns, REPO_DATA.apply_txns(txns))
+            REPO_DATA.idempotency_cache.put(key, response, request_hash=this_request)
+    BROKER.publish("txn", response)
+    return response
 
 
 def json_txn_method(fn: typing.Callable[[typing.Dict], data_repo.Transaction]):
+    TXN_TYPES[fn.__name__] = fn
+
+    def make_txns():
+        try:
+            return [fn(bottle.request.json)]
+        except (AttributeError, KeyError, TypeError, ValueError, decimal.InvalidOperation) as e:
+            raise bottle.HTTPError(400, "Invalid transaction: %r" % (e,))
+
     @wraps(fn)
     def result():
-        txn = fn(bottle.request.json)
-        member_deltas = REPO_DATA.apply_txn(txn)
-        return {
-            "members": {
-                member.internal_name: {
-                    "balance": str(-member.balance_eur),
-                    "items": member.item_count,
-                }
-                for member in member_deltas
-            },
-            "message": txn.beancount_txn.narration +
-                       (" (and now has €%s)" % (-txn.primary_account.balance_eur,)
-                        if txn.primary_account is not None
-                        else ""),
-        }
+        return apply_idempotently(make_txns, txn_response)
     return result
 
 
+@api.post("/txn/batch")
+def batch():
+    """Apply a list of transactions all at once. Each transaction is the
+    body of the corresponding /txn endpoint, with an additional "type"
+    field (deposit, transfer, or buy). If any of them is invalid, none
+    are applied."""
+    try:
+        body = bottle.request.json
+    except ValueError:
+        raise bottle.HTTPError(400, "Invalid JSON")
+    if not isinstance(body, dict) or not isinstance(body.get("transactions"), list):
+        raise bottle.HTTPError(400, 'Expected a JSON object with a "transactions" list')
+    if not body["transactions"]:
+        raise bottle.HTTPError(400, "Empty batch")
+
+    def make_txns():
+        txns = []
+        for i, txn_json in enumerate(body["transactions"]):
+            try:
+                txns.append(TXN_TYPES[txn_json["type"]](txn_json))
+            except (AttributeError, KeyError, TypeError, ValueError, decimal.InvalidOperation) as e:
+                raise bottle.HTTPError(400, "Invalid transaction %d: %r" % (i, e))
+        return txns
+
+    def respond(txns, member_deltas):
+        response = txn_response(txns, member_deltas)
+        response["messages"] = [txn.beancount_txn.narration for txn in txns]
+        return response
+    return apply_idempotently(make_txns, respond)
+
+
 @api.post("/txn/deposit")
 @json_txn_method
 def deposit(json):
     return data_repo.DepositTxn(
         member=REPO_DATA.accounts[json["member"]],
-        amount=decimal.Decimal(json["amount"]),
+        amount=data_repo.parse_price(json["amount"]),
     )
 
 
@@ -86,7 +484,7 @@ def transfer(json):
     return data_repo.TransferTxn(
         payer=REPO_DATA.accounts[json["payer"]],
         payee=REPO_DATA.accounts[json["payee"]],
-        amount=decimal.Decimal(json["amount"]),
+        amount=data_repo.parse_price(json["amount"]),
     )
 
 
@@ -107,15 +505,42 @@ def buy(json):
 @click.option('-c', "--config-file", default="config.yml",
               type=click.Path(dir_okay=False, resolve_path=True, exists=True))
 def main(config_file):
+    metrics.STARTUP_SECONDS.set(time.perf_counter() - STARTED, phase="imported")
     notifier = sdnotify.SystemdNotifier()
     # Load config
     SERVER_CONFIG.load_from_config(config_file)
-    REPO_DATA.pull_changes()
 
+    def synchronized():
+        elapsed = time.perf_counter() - STARTED
+        metrics.STARTUP_SECONDS.set(elapsed, phase="synchronized")
+        print("Synchronized with the remote %.2fs after starting" % (elapsed,))
+        notifier.notify("STATUS=Synchronized")
+
+    if SERVER_CONFIG.STARTUP == "deferred":
+        REPO_DATA.start_deferred(on_synchronized=synchronized)
+        notifier.notify("STATUS=%s; pulling in the background"
+                        % ("Serving from the snapshot" if REPO_DATA.loaded else "Waiting for the ledger",))
+    else:
+        # The ledger doesn't load with what a crash left half-written
+        REPO_DATA.commit_leftovers()
+        REPO_DATA.pull_changes()
+        REPO_DATA.start_committer()
+        REPO_DATA.start_sync()
+        synchronized()
+
+    metrics.STARTUP_SECONDS.set(time.perf_counter() - STARTED, phase="serving")
     notifier.notify("READY=1")
     root = bottle.Bottle()
     root.mount('/api/v1', api)
-    bottle.run(root, host=SERVER_CONFIG.LISTEN_ADDR, port=SERVER_CONFIG.PORT)
+    # systemd and docker stop us with SIGTERM; turn that into a normal
+    # shutdown so that the finally clause below gets to run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        run_server(root)
+    finally:
+        # Don't leave acknowledged transactions sitting in the working tree
+        REPO_DATA.flush()
+        REPO_DATA.close_instance_ledger()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
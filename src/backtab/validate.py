@@ -0,0 +1,264 @@
+# Checks a data repo the way the server loads it, so that a broken change
+# can be caught before it's pushed rather than rolled back by
+# pull_changes.
+#
+# To check a working tree (e.g., from a pre-commit hook):
+#     backtab-validate /path/to/tab-data
+# To check a commit in a bare repo (e.g., from a pre-receive hook, for
+# each pushed ref):
+#     backtab-validate --rev "$newrev" "$GIT_DIR"
+#
+# Parsing is by far the slowest part of loading, and a push rarely touches
+# more than one or two files, so parse results are cached per file, keyed
+# by path and content. Everything after parsing (includes, booking,
+# plugins, validation) runs as it does in the server; that needs the
+# whole ledger, so it isn't cached beyond what beancount does itself for
+# an unchanged working tree.
+
+import contextlib
+import decimal
+import glob
+import hashlib
+import io
+import os
+import pickle
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import typing
+
+import beancount
+import beancount.core.account as bcacct
+import beancount.core.data as bcdata
+import beancount.loader
+import beancount.parser.parser
+import beancount.parser.printer
+import click
+
+from backtab import data_repo
+
+# Same as the lexer's
+CURRENCY_RE = re.compile(r"^[A-Z][A-Z0-9'._-]{0,22}[A-Z0-9]$")
+CENT = decimal.Decimal("0.01")
+
+
+class ParseCache:
+    """Parse results by file, stored as pickles in cache_dir. The key is the
+    path relative to root along with the content, so that a cache can be
+    shared between checkouts in different places."""
+    cache_dir: str
+    root: str
+    hits: int
+    misses: int
+
+    def __init__(self, cache_dir: str, root: str):
+        self.cache_dir = cache_dir
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def parse_file(self, filename: str, **kwargs):
+        with open(filename, "rb") as f:
+            content = f.read()
+        relpath = os.path.relpath(filename, self.root)
+        # One cache file per source file; the name says which content it's for
+        prefix = hashlib.sha1(relpath.encode("utf-8")).hexdigest()[:16]
+        digest = hashlib.sha1(content)
+        digest.update(repr((beancount.__version__, sorted(kwargs.items()))).encode("utf-8"))
+        cache_filename = os.path.join(self.cache_dir, "%s-%s.pickle" % (prefix, digest.hexdigest()))
+
+        try:
+            with open(cache_filename, "rb") as f:
+                cached_filename, result = pickle.load(f)
+            self.hits += 1
+            if cached_filename != filename:
+                _move_metadata(result, filename)
+            return result
+        except (OSError, pickle.PickleError, EOFError, ValueError):
+            pass
+
+        self.misses += 1
+        result = beancount.parser.parser.parse_file(filename, **kwargs)
+        for stale in glob.glob(os.path.join(self.cache_dir, prefix + "-*.pickle")):
+            os.unlink(stale)
+        with open(cache_filename + ".tmp", "wb") as f:
+            pickle.dump((filename, result), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_filename + ".tmp", cache_filename)
+        return result
+
+
+def _move_metadata(result, filename: str):
+    """Point the metadata of cached parse results at where the file is now"""
+    entries, errors, options_map = result
+    for entry in entries:
+        entry.meta["filename"] = filename
+        for posting in getattr(entry, "postings", None) or []:
+            if posting.meta is not None and "filename" in posting.meta:
+                posting.meta["filename"] = filename
+    for error in errors:
+        if error.source is not None and "filename" in error.source:
+            error.source["filename"] = filename
+    options_map["filename"] = filename
+
+
+class _CachedParser:
+    """Stands in for beancount.parser.parser in the loader"""
+
+    def __init__(self, cache: ParseCache):
+        self._cache = cache
+
+    def parse_file(self, filename, **kwargs):
+        return self._cache.parse_file(filename, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(beancount.parser.parser, name)
+
+
+@contextlib.contextmanager
+def cached_parsing(cache: ParseCache):
+    """Have beancount.loader parse files through the cache"""
+    loader_parser = beancount.loader.parser
+    beancount.loader.parser = _CachedParser(cache)
+    try:
+        yield
+    finally:
+        beancount.loader.parser = loader_parser
+
+
+def check_products(raw_products: typing.List[typing.Dict]) -> typing.List[str]:
+    """Checks on the product catalog beyond what loading it does"""
+    problems = []
+    for i, raw_product in enumerate(raw_products):
+        name = "Product %d (%s)" % (i, raw_product.get("name", "unnamed"))
+        if not CURRENCY_RE.match(str(raw_product["currency"])):
+            problems.append("%s: %r is not a valid beancount currency" % (name, raw_product["currency"]))
+        if "event_price" not in raw_product:
+            problems.append("%s: no event_price, so it can't be sold in event mode" % (name,))
+        else:
+            try:
+                data_repo.parse_price(raw_product["event_price"])
+            except (decimal.InvalidOperation, TypeError, ValueError):
+                problems.append("%s: invalid event_price %r" % (name, raw_product["event_price"]))
+        if "visible" in raw_product and not isinstance(raw_product["visible"], bool):
+            problems.append("%s: visible should be true or false" % (name,))
+        if "payback" in raw_product and not bcacct.is_valid(raw_product["payback"]["account"]):
+            problems.append("%s: invalid payback account %r" % (name, raw_product["payback"]["account"]))
+    return problems
+
+
+def check_members(entries: typing.List[bcdata.Directive],
+                  accounts_raw: typing.Dict[str, data_repo.Member]) -> typing.List[str]:
+    """Checks on the member accounts beyond what loading them does"""
+    problems = []
+    for entry in entries:
+        if isinstance(entry, bcdata.Open):
+            account = entry.account
+            if (account.startswith(data_repo.MEMBERS_ACCT + ":")
+                    and not data_repo.is_bar_account(account)):
+                problems.append("%s: member accounts must be directly under %s, so this one won't be loaded"
+                                % (account, data_repo.MEMBERS_ACCT))
+            if "display_name" in entry.meta and not isinstance(entry.meta["display_name"], str):
+                problems.append("%s: display_name should be a string" % (account,))
+        elif isinstance(entry, bcdata.Transaction):
+            for posting in entry.postings:
+                # Members' balances are kept in whole cents
+                if (posting.units.currency == "EUR" and data_repo.is_bar_account(posting.account)
+                        and posting.units.number != posting.units.number.quantize(CENT)):
+                    problems.append("%s:%d: %s is not a whole number of cents"
+                                    % (entry.meta["filename"], entry.meta["lineno"], posting.units))
+    # Typically a product that got renamed or removed, so one line per
+    # currency rather than per member
+    holders = {}
+    for member in accounts_raw.values():
+        for position in member.other_balance if member.other_balance is not None else []:
+            holders.setdefault(position.units.currency, []).append(member.internal_name)
+    for currency, names in sorted(holders.items()):
+        problems.append("%d member(s) hold %s, which is neither EUR nor a product: %s"
+                        % (len(names), currency, ", ".join(names[:5]) + (", ..." if len(names) > 5 else "")))
+    return problems
+
+
+def validate(repo_path: str, cache_dir: str) -> typing.Tuple[typing.List[str], typing.List[str]]:
+    """Check the data repo checked out at repo_path. Returns the errors,
+    which would make the server refuse the repo, and the warnings."""
+    errors = []
+    warnings = []
+    repo = data_repo.RepoData(repo_path=repo_path)
+    products = None
+    try:
+        raw_products, products = repo.load_products()
+        warnings.extend(check_products(raw_products))
+    except Exception as e:
+        errors.append("static/products.yml: %s: %s" % (type(e).__name__, e))
+
+    cache = ParseCache(cache_dir, repo_path)
+    with cached_parsing(cache):
+        entries, load_errors, _ = beancount.loader.load_file(os.path.join(repo_path, "bartab.beancount"))
+    if load_errors:
+        error_stream = io.StringIO()
+        beancount.parser.printer.print_errors(load_errors, error_stream)
+        errors.append(error_stream.getvalue().rstrip())
+
+    if products is not None:
+        product_currencies = {currency: index for index, currency in enumerate(products)}
+        try:
+            # The accounts it skips are reported by check_members
+            with contextlib.redirect_stdout(io.StringIO()):
+                _, accounts_raw = data_repo.build_members(entries, product_currencies)
+            warnings.extend(check_members(entries, accounts_raw))
+        except Exception as e:
+            errors.append("Members: %s: %s" % (type(e).__name__, e))
+    print("Parse cache: %d hits, %d misses" % (cache.hits, cache.misses), file=sys.stderr)
+    return errors, warnings
+
+
+@contextlib.contextmanager
+def checkout(git_dir: str, rev: str):
+    """Export the tree at rev into a temporary directory"""
+    path = tempfile.mkdtemp(prefix="backtab-validate-")
+    try:
+        archive = subprocess.run(["git", "--git-dir", git_dir, "archive", "--format=tar", rev],
+                                 stdout=subprocess.PIPE, check=True).stdout
+        subprocess.run(["tar", "-x", "-C", path], input=archive, check=True)
+        yield path
+    finally:
+        shutil.rmtree(path)
+
+
+def default_cache_dir(repo: str) -> str:
+    git_dir = subprocess.check_output(["git", "rev-parse", "--absolute-git-dir"], cwd=repo)
+    return os.path.join(git_dir.decode("utf-8").strip(), "backtab-validate-cache")
+
+
+@click.command()
+@click.argument("repo", default=".", type=click.Path(file_okay=False, exists=True, resolve_path=True))
+@click.option("--rev", help="Check this commit instead of the working tree; works in bare repos")
+@click.option("--cache-dir", type=click.Path(file_okay=False, resolve_path=True),
+              help="Where to cache parse results; defaults to backtab-validate-cache in the git dir")
+@click.option("--strict", is_flag=True, help="Fail on warnings too")
+def main(repo, rev, cache_dir, strict):
+    if cache_dir is None:
+        cache_dir = default_cache_dir(repo)
+    if rev is None:
+        errors, warnings = validate(repo, cache_dir)
+    else:
+        # The export is thrown away afterwards, so beancount's own cache of
+        # the whole ledger would only cost time to write
+        beancount.loader.initialize(use_cache=False)
+        with checkout(repo, rev) as path:
+            errors, warnings = validate(path, cache_dir)
+
+    for warning in warnings:
+        print("Warning: " + warning)
+    for error in errors:
+        print("Error: " + error)
+    if errors or (strict and warnings):
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()